@@ -1,29 +1,48 @@
-import io
 import logging
 import os
 import time
-import datetime
 from imutils.video import VideoStream, FPS
 from imutils import resize
-from photobooth.photobooth.tools import GIFCreator
+from photobooth.photobooth.tools import GIFCreator, StreamingGIFCreator, GIF_MEMORY_BUDGET
+from photobooth.photobooth.capture import PreviewGrabber, PreviewDecoder, CaptureQueue, decode_reduced
+from photobooth.photobooth.overlays import OverlayCache
+from photobooth.photobooth.display import DisplayPipeline
+from photobooth.photobooth.animations import Animator, SnapReview, Playback, Flash
+from photobooth.photobooth.strip import StripSession, compose_strip, STRIP_FRAME_WIDTH
+from photobooth.photobooth.events import InputBus
+from photobooth.photobooth.replay import SOI
+from photobooth.photobooth.persistence import PersistenceQueue, ImageNames, write_atomic, encode_jpeg, resize_width
+from photobooth.photoserver.gallery import get_gallery
+from photobooth.photoserver.variants import VariantEncoder
+from photobooth.photoserver.metrics import Metrics
+from photobooth.photoserver.tracing import Tracer
 from enum import Enum
+from functools import partial
+from queue import Queue, Empty
 from threading import Thread, Event, Lock
 from multiprocessing import Process
+import hmac
 import signal
+import socket
 import subprocess
 import numpy as np
 import cv2
-import gphoto2 as gp
 import pygame
 
 logging.basicConfig(
     format='%(levelname)s: %(name)s: %(message)s', level=logging.DEBUG)
 
+# seconds the preview loop waits for a new camera frame before it handles input again
+PREVIEW_WAIT = 0.05
+# seconds between metrics snapshots for the photoserver and the debug overlay
+METRICS_INTERVAL = 1.0
+
 
 class Camera(Enum):
     raspicam = "raspicam"
     v4l2 = "v4l2"
     gphoto2 = "gphoto2"
+    replay = "replay"
 
     def __str__(self):
         return self.value
@@ -35,39 +54,44 @@ class Action(Enum):
     photo = "photo"
     interval = "interval"
     gif = "gif"
+    strip = "strip"
     print_last_photo = "print_last_photo"
     info = "info"
     effect_next = "next_effect"
     effect_prev = "prev_effect"
     effect_none = "none_effect"
+    metrics = "metrics"
 
 
 class Input:
+    """
+    Source of actions. Sources push InputEvents to the InputBus given to start(),
+    either from their own thread or from poll(), which the preview loop calls
+    every frame. The default poll() pushes the result of get_action().
+    """
 
     def __init__(self):
         # setup logger
         self.log = logging.getLogger(self.__class__.__name__)
-        # self.last_action = Action.none
-        # self.event = Event()
-
-    #     self.thread = Thread(target=self._update_thread)
-    #     self.thread.start()
-    #
-    # def _update_thread(self):
-    #     while not self.event.is_set():
-    #         self._update()
-    #
-    # def _update(self):
-    #     raise NotImplementedError
+        self.bus = None
+
+    @property
+    def name(self):
+        return self.__class__.__name__
+
+    def start(self, bus):
+        self.bus = bus
 
     def close(self):
         pass
 
+    def poll(self):
+        action = self.get_action()
+        if action is not Action.none:
+            self.bus.push(action, self.name)
+
     def get_action(self):
         raise NotImplementedError
-        # action = self.last_action
-        # self.last_action = Action.none
-        # return action
 
 
 class KeyboardInput(Input):
@@ -79,29 +103,30 @@ class KeyboardInput(Input):
                            pygame.K_SPACE: Action.photo,
                            pygame.K_ESCAPE: Action.exit,
                            pygame.K_g: Action.gif,
+                           pygame.K_s: Action.strip,
                            pygame.K_p: Action.print_last_photo,
                            pygame.K_i: Action.info,
+                           pygame.K_m: Action.metrics,
                            pygame.K_LEFT: Action.effect_prev,
                            pygame.K_RIGHT: Action.effect_next,
                            pygame.K_DOWN: Action.effect_none}
         else:
             self.keymap = keymap
 
-    def get_action(self):
+    def poll(self):
+        # pygame events can only be read by the thread of the display
         try:
             events = pygame.event.get()
-            # loop events
-            for event in events:
-                if event.type == pygame.KEYDOWN:
-                    self.log.debug(event.key)
-                    self.log.debug(event)
-                    self.log.debug(self.keymap)
-                    if event.key in self.keymap.keys():
-                        return self.keymap[event.key]
         except pygame.error as e:
             self.log.error(e)
-
-        return Action.none
+            return
+        t = time.perf_counter()
+        # every mapped key of the batch, in order
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                self.log.debug(event)
+                if event.key in self.keymap:
+                    self.bus.push(self.keymap[event.key], self.name, t)
 
 
 class GPIOInput(Input):
@@ -120,7 +145,6 @@ class GPIOInput(Input):
         else:
             self.pinmap = pinmap
 
-        self.last_action = Action.none
         self.setup()
 
     def setup(self):
@@ -132,24 +156,129 @@ class GPIOInput(Input):
             GPIO.add_event_detect(k, GPIO.FALLING, bouncetime=1000, callback=self.callback)
 
     def callback(self, channel):
-        if channel in self.pinmap.keys():
-            self.last_action = self.pinmap[channel]
-
-    def get_action(self):
-        # import RPi.GPIO as GPIO
-        # for k in self.pinmap.keys():
-        #     if GPIO.event_detected(k):
-        #         self.log.debug("Pressed GPIO: {} for {}".format(k, self.pinmap[k]))
-        #         return self.pinmap[k]
-        action = self.last_action
-        self.last_action = Action.none
-        return action
+        # runs in the edge detection thread of RPi.GPIO
+        t = time.perf_counter()
+        if channel in self.pinmap.keys() and self.bus is not None:
+            self.log.debug("Pressed GPIO: {} for {}".format(channel, self.pinmap[channel]))
+            self.bus.push(self.pinmap[channel], self.name, t)
+
+    def poll(self):
+        # edges are pushed by callback()
+        pass
 
     def close(self):
         import RPi.GPIO as GPIO
         GPIO.cleanup()
 
 
+class UDPInput(Input):
+    """
+    Actions sent as UDP datagrams, e.g. from a wireless trigger or another computer:
+
+        echo -n "secret photo" | nc -u -w0 photobooth.local 5005
+
+    A datagram holds the value of one Action ("photo", "interval", "gif", "strip", ...),
+    preceded by the shared token and a space if one is set. It listens on localhost
+    only by default, guests on the booth's network must not trigger it.
+    """
+
+    def __init__(self, host="127.0.0.1", port=5005, actions=None, token=None):
+        """
+        :param host: address to listen on, e.g. "0.0.0.0" for all interfaces
+        :param port: UDP port
+        :param actions: accepted actions, all but exit and print_last_photo if None
+        :param token: shared secret every datagram has to start with or None
+        """
+        super(UDPInput, self).__init__()
+        if actions is None:
+            actions = [action for action in Action
+                       if action not in (Action.none, Action.exit, Action.print_last_photo)]
+        self.actions = {action.value: action for action in actions}
+        self.token = token
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        # wake up regularly to notice close()
+        self.socket.settimeout(0.5)
+        self.event = Event()
+        self.thread = None
+        self.log.info("listening for actions on udp://{}:{:d}".format(host, port))
+
+    def start(self, bus):
+        super(UDPInput, self).start(bus)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.event.is_set():
+            try:
+                data, address = self.socket.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self.event.is_set():
+                    self.log.error(e)
+                break
+            t = time.perf_counter()
+            value = data.decode("utf-8", "replace").strip()
+            if self.token is not None:
+                token, _, value = value.partition(" ")
+                if not hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8")):
+                    self.log.warning("datagram without valid token from {}".format(address[0]))
+                    continue
+            action = self.actions.get(value.strip().lower())
+            if action is None:
+                self.log.warning("unknown action {!r} from {}".format(value, address[0]))
+                continue
+            self.bus.push(action, self.name, t)
+
+    def poll(self):
+        # datagrams are pushed by the listener thread
+        pass
+
+    def close(self):
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.socket.close()
+
+
+class ScriptedInput(Input):
+    """
+    Replays a list of actions at fixed times, e.g. for benchmarks.
+    Times are relative to the first get_action() call.
+    """
+
+    def __init__(self, script, repeat=None):
+        """
+        :param script: list of (seconds, Action)
+        :param repeat: period in seconds to repeat the script or None
+        """
+        super(ScriptedInput, self).__init__()
+        self.script = sorted(script, key=lambda item: item[0])
+        self.repeat = repeat
+        self.t0 = None
+        self.index = 0
+        # seconds between the scheduled time and the time an action was taken, per action
+        self.lags = {}
+
+    def get_action(self):
+        now = time.time()
+        if self.t0 is None:
+            self.t0 = now
+        if self.index >= len(self.script):
+            if self.repeat is None or now - self.t0 < self.repeat:
+                return Action.none
+            self.t0 += self.repeat
+            self.index = 0
+        at, action = self.script[self.index]
+        if now - self.t0 < at:
+            return Action.none
+        self.index += 1
+        self.lags.setdefault(action, []).append(now - self.t0 - at)
+        return action
+
+
 class Photobooth:
 
     def __init__(self, image_dir=".",
@@ -159,11 +288,24 @@ class Photobooth:
                  review_time=2,
                  gif_length=5,
                  gif_pause=1.0,
+                 gif_memory_budget=GIF_MEMORY_BUDGET,
+                 strip_length=4,
+                 strip_countdown=3,
                  input_handler=None,
+                 udp_host="127.0.0.1",
+                 udp_port=None,
+                 udp_token=None,
+                 udp_actions=None,
                  server=True,
+                 server_mode="thread",
+                 server_host="127.0.0.1",
+                 server_port=5000,
+                 server_workers=1,
                  flip_h=False,
                  flip_v=False,
-                 cam_type=Camera.v4l2):
+                 cam_type=Camera.v4l2,
+                 replay_source=None,
+                 replay_fps=None):
 
         # options
         self.image_dir = image_dir
@@ -173,6 +315,9 @@ class Photobooth:
         self.review_time = review_time
         self.gif_length = gif_length
         self.gif_pause = gif_pause
+        self.gif_memory_budget = gif_memory_budget
+        self.strip_length = strip_length
+        self.strip_countdown = strip_countdown
         if input_handler is None:
             input_handler = [KeyboardInput()]
             try:
@@ -180,109 +325,159 @@ class Photobooth:
             except Exception as e:
                 print(e)
                 pass
+        if udp_port is not None:
+            input_handler.append(UDPInput(udp_host, udp_port, actions=udp_actions, token=udp_token))
         self.input_handler = input_handler
         self.start_server = server
+        self.server_mode = server_mode
+        self.server_host = server_host
+        self.server_port = server_port
+        self.server_workers = server_workers
         self.flip_h = flip_h
         self.flip_v = flip_v
         self.cam_type = cam_type
+        self.replay_source = replay_source
+        self.replay_fps = replay_fps
         self.verbose = verbose
 
+        # gallery index shared with the photoserver
+        self.gallery = get_gallery(self.image_dir)
+        # WebP/AVIF variants of published thumbnails
+        self.variant_encoder = VariantEncoder(callback=self._variants_written)
+        # saves captures off the preview loop
+        self.persistence = PersistenceQueue()
+        # unique names of captures, also within a second
+        self.image_names = ImageNames(os.path.join(self.image_dir, "images"))
+        # finished strips waiting for their review in the preview loop
+        self.reviews = Queue()
+
         # setup logger
         self.log = logging.getLogger("Photobooth")
         self.log.setLevel(logging.DEBUG if verbose else logging.INFO)
 
         # pygame window
         self.screen = None
+        self.display = None
+        self.overlays = OverlayCache()
+        # review and playback animations shown instead of the preview
+        self.animator = Animator()
+        # stage timings of the preview loop
+        self.metrics = Metrics()
         self.frame_count = 0
+        self.gif_frames_dropped = 0
+        # timestamped actions of all input sources
+        self.bus = InputBus(metrics=self.metrics)
+        for handler in self.input_handler:
+            handler.start(self.bus)
+        # spans of every capture from the press until it is in the gallery
+        self.tracer = Tracer(self.image_dir)
 
         # threading
         self.event = Event()
         self.server_thread = None
+        self.server_process = None
         self.preview_thread = None
 
         # start HTTP server
         if self.start_server:
-            self.server_thread = Thread(target=self.run_server, daemon=True)
-            self.server_thread.start()
+            if self.server_mode == "process":
+                # separate process(es) that don't compete with the preview for the GIL
+                from photobooth.photoserver.server import serve
+                self.server_process = Process(target=serve, args=(self.image_dir,),
+                                              kwargs=dict(host=self.server_host,
+                                                          port=self.server_port,
+                                                          workers=self.server_workers),
+                                              daemon=True)
+                self.server_process.start()
+            else:
+                self.server_thread = Thread(target=self.run_server, daemon=True)
+                self.server_thread.start()
 
     def __del__(self):
         self.close()
 
-    def run_server(self):
+    def run_server(self, workers=1):
         self.log.info("start server")
-        from gevent.pywsgi import WSGIServer
-        from photobooth.photoserver import app
-        app.config["IMAGE_DIR"] = self.image_dir
-        http_server = WSGIServer(('127.0.0.1', 5000), app)
-        http_server.serve_forever()
+        from photobooth.photoserver.server import serve
+        serve(self.image_dir, host=self.server_host, port=self.server_port, workers=workers)
 
     def close(self):
         self.event.set()
         if self.preview_thread is not None:
             # self.preview_thread.terminate()
             self.preview_thread.join()
+        if self.server_process is not None and self.server_process.is_alive():
+            self.server_process.terminate()
+            self.server_process.join()
         for handler in self.input_handler:
             handler.close()
+        self.persistence.close()
+        self.variant_encoder.close()
 
-    def update_window(self, frame, overlays=[]):
-        info = pygame.display.Info()
-        # frame = resize(frame, height=info.current_h)
-        # convert and add image
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame = np.rot90(frame)
-        frame = pygame.surfarray.make_surface(frame)
-        frame = pygame.transform.flip(frame, True, False)
-        frame = pygame.transform.scale(frame, (info.current_w, info.current_h))
-        self.screen.blit(frame, (0, 0))
+    def update_window(self, frame, overlays=None):
+        t = time.perf_counter()
+        # scale and add image
+        self.display.show(frame)
+        t_scaled = time.perf_counter()
 
         # add overlays
+        overlays = list(overlays) if overlays is not None else []
         if self.verbose:
-            font = pygame.font.SysFont('freesans', 28, bold=True)
             text = "frame #{:d}".format(self.frame_count)
-            overlays.append((font.render(text, 1, pygame.Color(255, 255, 255)), 0, info.current_h - 30))
+            overlays.append((self.overlays.text(text, size=28), 0, self.display.size[1] - 30))
         for overlay, x, y in overlays:
             self.screen.blit(overlay, (x, y))
+        t_blitted = time.perf_counter()
 
         # show!
         pygame.display.update()
+        self.metrics.record("scale", t_scaled - t)
+        self.metrics.record("blit", t_blitted - t_scaled)
+        self.metrics.record("flip", time.perf_counter() - t_blitted)
 
-    def show_snap(self, img, review_time=2):
-        img_resized = resize(img, width=self.preview_width)
-
-        # show flash
-        white = np.ones(img_resized.shape, dtype=np.uint8) * 255
-        self.update_window(white)
-        time.sleep(0.2)
-
-        # show snapshot
-        self.update_window(img_resized)
-        time.sleep(review_time)
+    def update_metrics(self, grabber, fps):
+        """
+        Updates the gauges, writes a snapshot for the photoserver and
+        renders the debug overlay
+        """
+        stats = grabber.stats()
+        for name in ("capture_fps", "dropped", "duplicates"):
+            self.metrics.set("preview_" + name, stats[name])
+        self.metrics.set("fps", fps)
+        self.metrics.set("frames", self.frame_count)
+        self.metrics.set("display_conversions", self.display.conversions)
+        self.metrics.set("gif_frames_dropped", self.gif_frames_dropped)
+        self.metrics.set("persistence_queue_depth", self.persistence.depth)
+        self.metrics.set("input_pending", self.bus.pending)
+        snapshot = self.metrics.snapshot()
+        try:
+            self.metrics.dump(self.image_dir)
+        except (IOError, OSError) as e:
+            self.log.warning("writing metrics failed: {}".format(e))
+
+        lines = ["{:>10s} {:>8s} {:>8s} {:>8s}".format("stage", "p50 ms", "p95 ms", "max ms")]
+        for stage, summary in sorted(snapshot["stages"].items()):
+            if summary["p50_ms"] is not None:
+                lines.append("{:>10s} {:8.2f} {:8.2f} {:8.2f}".format(
+                    stage, summary["p50_ms"], summary["p95_ms"], summary["max_ms"]))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("{:>24s} {:.5g}".format(name, value))
+        return [(self.overlays.text(line, name="freemono", size=16), 10, 40 + 18 * i)
+                for i, line in enumerate(lines)]
 
-        # blur image
-        for i in np.arange(1, 51, 4):
-            frame = cv2.blur(img_resized, (i, i))
-            self.update_window(frame)
-            time.sleep(0.05)
+    def show_snap(self, img, review_time=2):
+        """
+        Starts the flash and review animation of a photo, the preview loop plays it
+        """
+        self.animator.play(SnapReview(img, self.display.size, review_time=review_time))
 
     def show_gif(self, buffer, pause=0.3, repeat=5):
-        overlays = []
-        font = pygame.font.SysFont('freesans', 30, bold=True)
-        text = "GIF playback..."
-        overlay = font.render(text, 1, pygame.Color(0, 255, 0, 128))
-        overlay_box = pygame.Surface(self.screen.get_size(),
-                                     flags=pygame.HWSURFACE | pygame.SRCALPHA)
-        pygame.draw.rect(overlay_box, (0, 255, 0, 128),
-                         pygame.Rect(0, 0,
-                                     self.screen.get_size()[0],
-                                     self.screen.get_size()[1]),
-                         15)
-        overlays.append((overlay, 10, 10))
-        overlays.append((overlay_box, 0, 0))
-        for i in range(repeat):
-            for img in buffer.images:
-                # cv2.rectangle(img, (0, 0), (img.shape[1], img.shape[0]), (0, 255, 0), 5)
-                self.update_window(img, overlays)
-                time.sleep(pause)
+        """
+        Starts the playback of a recorded GIF, the preview loop plays it
+        """
+        overlays = [(self.overlays.text("GIF playback...", color=(0, 255, 0, 128)), 10, 10),
+                    (self.overlays.frame((0, 255, 0, 128)), 0, 0)]
+        self.animator.play(Playback(buffer.images, pause=pause, repeat=repeat, overlays=overlays))
 
     def _preview(self):
         # setup window
@@ -296,6 +491,9 @@ class Photobooth:
         pygame.display.set_caption("Photobooth")
         pygame.mouse.set_visible(False)
         self.screen = pygame.display.set_mode((0, 0), flags, 32)
+        self.display = DisplayPipeline(self.screen)
+        self.overlays.resize(self.screen.get_size())
+        self.overlays.prerender_countdown(max(self.timer_limit, self.strip_countdown))
 
         # init camera
         # camera = self.init_camera()
@@ -303,13 +501,31 @@ class Photobooth:
             PhotoboothCam = RaspiboothCam
         elif self.cam_type == Camera.gphoto2:
             PhotoboothCam = GPhotoboothCam
+        elif self.cam_type == Camera.replay:
+            PhotoboothCam = ReplayCam
         else:
             PhotoboothCam = PhotoboothDefaultCam
+        options = {}
+        if self.cam_type == Camera.replay:
+            options = dict(source=self.replay_source, fps=self.replay_fps)
         camera = PhotoboothCam(verbose=self.verbose,
                                flip_h=self.flip_h,
                                flip_v=self.flip_v,
-                               preview_width=self.preview_width)
+                               preview_width=self.preview_width,
+                               **options)
+        camera.metrics = self.metrics
         camera.init_camera()
+        # full resolution captures of strips, wide enough for review, thumbnail and strip
+        capture = CaptureQueue(camera, max(self.thumb_width, self.preview_width, STRIP_FRAME_WIDTH))
+        # capture preview frames in background
+        grabber = PreviewGrabber(camera, metrics=self.metrics)
+        if not grabber.start():
+            self.log.error("Got no preview image...exit")
+            capture.close()
+            grabber.stop()
+            camera.close()
+            pygame.quit()
+            return 1
 
         # start preview
         if camera is not None:
@@ -317,13 +533,19 @@ class Photobooth:
             t0 = time.time()
             timer_active = False
             trigger = False
-            last_snap = None
+            interval_trace = None
             last_snap_path = None
-            # gif
+            # gif, recording and the last one recorded, which may still be encoding
             gif_buffer = None
+            last_gif = None
+            # photo strip, None if no shots are left to take
+            strip = None
 
             info = False
             overlays = []
+            show_metrics = False
+            metrics_overlays = []
+            t_metrics = time.time()
 
             # handle signals
 
@@ -332,6 +554,8 @@ class Photobooth:
                 self.event.set()
 
             signal.signal(signal.SIGINT, keyboardInterruptHandler)
+            # input ends the wait for the next preview frame
+            self.bus.subscribe(grabber.ring.wake)
 
             # counter, fps
             i = 0
@@ -339,64 +563,115 @@ class Photobooth:
             # setup thread stop event
             self.event.clear()
             while not self.event.is_set():
-                # show last snap
-                if last_snap is not None:
-                    self.show_snap(last_snap, review_time=self.review_time)
-                    last_snap = None
-                # self.log.debug('Capturing preview image {:06d}'.format(i))
-                img = camera.take_preview_image()
-
-                img_preview = img.copy()
-                if img is None:
-                    self.log.error("Got None image for preview...exit")
+                t_frame = time.perf_counter()
+                self.metrics.begin()
+                # newest preview frame, valid until the next call, pending input doesn't wait for one
+                img = grabber.latest(None if self.bus.pending else PREVIEW_WAIT)
+                self.metrics.lap("wait")
+                if grabber.error is not None:
+                    self.log.error("Preview capture failed...exit")
                     self.event.set()
                     break
+
                 width, height = img.shape[1], img.shape[0]
 
                 # get action
-                action = self.get_action()
+                event = self.get_event()
+                action = event.action if event is not None else Action.none
+                t_handled = time.perf_counter()
+                self.metrics.lap("input")
 
                 # handle action
                 if action is not Action.none:
                     self.log.info("ACTION: {}".format(action))
-                    # reset GIF buffer
+                    # stop GIF recording
+                    if gif_buffer is not None:
+                        gif_buffer.abort()
                     gif_buffer = None
+                    # any input ends review and playback
+                    self.animator.cancel()
                 if action == Action.exit:
                     break
                 elif action == Action.photo or trigger:  # SPACE = direct photo
-                    camera.flash_on()
-                    # take photo
-                    img_full = camera.take_photo()
+                    if action == Action.photo or interval_trace is None:
+                        trace = self.start_trace("photo", event, t_handled)
+                    else:
+                        trace = interval_trace
+                        trace.since_last("countdown")
+                    interval_trace = None
+                    with trace.span("flash_on"):
+                        camera.flash_on()
+                    # take photo, the preview capture waits meanwhile
+                    jpeg = img_full = None
+                    try:
+                        with trace.span("take_photo"), camera.lock:
+                            jpeg = camera.take_photo_jpeg()
+                            img_full = camera.take_photo() if jpeg is None else None
+                    except Exception as e:
+                        self.log.error("capture failed: {}".format(e))
                     camera.flash_off()
-                    target = os.path.join(self.path_images, self.get_image_name())
-                    cv2.imwrite(target, img_full)
-                    last_snap_path = target
-                    # create thumbnail in new process
-                    Thread(target=self.create_thumb, args=(target,)).start()
-                    # reset trigger and timer
+                    if jpeg is not None:
+                        # the camera's JPEG is saved as it is, decode only what review and thumbnail need
+                        with trace.span("decode"):
+                            img_full = decode_reduced(jpeg, max(self.thumb_width, self.preview_width))
                     trigger = timer_active = False
-                    # load last snap
-                    last_snap = img_full
+                    if img_full is None:
+                        self.log.error("no image captured, nothing saved")
+                        trace.finish(error="no image")
+                    else:
+                        target = os.path.join(self.path_images, self.get_image_name())
+                        # save image and thumbnail in background
+                        self.persistence.submit(self.save_photo, img_full, target, jpeg, trace)
+                        last_snap_path = target
+                        # review last snap
+                        self.show_snap(img_full, review_time=self.review_time)
                 elif action == Action.interval:  # a - photo after 3 seconds
                     t0 = time.time()
                     timer_active = True
+                    interval_trace = self.start_trace("interval", event, t_handled)
                     camera.flash_on()
+                elif action == Action.strip:
+                    if strip is None:
+                        self.log.info("Start strip of {:d} photos".format(self.strip_length))
+                        name, ext = os.path.splitext(self.get_image_name())
+                        strip = StripSession(self.strip_length, self.strip_countdown,
+                                             os.path.join(self.path_images, "{}_strip{}".format(name, ext)),
+                                             trace=self.start_trace("strip", event, t_handled))
                 elif action == Action.gif:
                     self.log.info("Start GIF")
+                    gif_trace = self.start_trace("gif", event, t_handled)
                     camera.flash_on()
-                    gif_buffer = GIFCreator(size=self.gif_length, pause=self.gif_pause)
+                    gif_name = self.get_image_name("gif")
+                    file_path = os.path.join(self.path_images, gif_name)
+                    self.log.info("record GIF to {}".format(file_path))
+                    if self.gif_memory_budget:
+                        # frames are encoded while they are recorded
+                        gif_buffer = StreamingGIFCreator(file_path, os.path.join(self.path_thumbs, gif_name),
+                                                         size=self.gif_length,
+                                                         pause=self.gif_pause,
+                                                         thumb_width=self.thumb_width,
+                                                         memory_budget=self.gif_memory_budget,
+                                                         callback=partial(self._gif_saved, gif_trace))
+                    else:
+                        # all frames in memory, encoded at once with a palette of all frames
+                        gif_buffer = GIFCreator(size=self.gif_length, pause=self.gif_pause)
                 elif action == Action.print_last_photo:
                     if last_snap_path is not None:
-                        self.print_image(last_snap_path)
-                        font = pygame.font.SysFont('symbola', 30, bold=True)
-                        text = "printing..."
-                        overlay = font.render(text, 1, pygame.Color(255, 255, 255))
-                        w, h = overlay.get_size()
-                        overlays.append((overlay, int(width / 2.0 - w / 2.0), int(height / 2.0 - h / 2.0)))
+                        trace = self.start_trace("print", event, t_handled)
+                        # the last snap may still be in the queue
+                        with trace.span("wait_saved"):
+                            self.persistence.join()
+                        with trace.span("print"):
+                            self.print_image(last_snap_path)
+                        trace.finish(name=os.path.basename(last_snap_path))
+                        overlay = self.overlays.text("printing...", name="symbola")
+                        overlays.append(self.overlays.centered(overlay, width, height))
                     else:
                         self.log.warning("No last snap to print!")
                 elif action == Action.info:
                     info = not info
+                elif action == Action.metrics:
+                    show_metrics = not show_metrics
                 elif action == Action.effect_next:
                     effect = camera.effect_next()
                     self.log.info("effect: {}".format(effect))
@@ -410,59 +685,95 @@ class Photobooth:
                     gif_buffer.update(img)
                     if gif_buffer.is_full():
                         camera.flash_off()
-                        file_path = os.path.join(self.path_images, self.get_image_name("gif"))
-                        file_path_thumb = os.path.join(self.path_thumbs, self.get_image_name("gif"))
-                        self.log.info("GIF buffer full, save GIF to {}".format(file_path))
-                        gif_buffer.save_to(file_path)
-                        gif_buffer.save_to(file_path_thumb)
+                        gif_trace.since_last("record")
+                        if isinstance(gif_buffer, GIFCreator):
+                            # one job encodes both GIFs, joined with the other saves on exit
+                            self.persistence.submit(gif_buffer.save,
+                                                    os.path.join(self.path_images, gif_name),
+                                                    os.path.join(self.path_thumbs, gif_name),
+                                                    self.thumb_width,
+                                                    partial(self._gif_saved, gif_trace))
+                        else:
+                            self.gif_frames_dropped += gif_buffer.dropped
                         self.log.info("Play GIF")
                         self.show_gif(gif_buffer)
+                        last_gif = gif_buffer
                         gif_buffer = None
 
+                # strip finished in background
+                try:
+                    self.show_snap(self.reviews.get_nowait(), review_time=self.review_time)
+                except Empty:
+                    pass
+
+                self.metrics.lap("action")
+
                 # draw timer if active
-                if timer_active:
+                if strip is not None:
+                    time_left = strip.time_left()
+                    if time_left <= 0:
+                        time_left = 0
+                        # the capture thread downloads and saves while the next countdown runs
+                        strip.trace.since_last("countdown_{:d}".format(strip.shots + 1))
+                        index = strip.shoot()
+                        target = os.path.join(self.path_images, self.get_image_name())
+                        capture.submit(partial(self._strip_shot, strip, index, target))
+                        self.animator.play(Flash(cancellable=False))
+                        if not strip.shooting:
+                            strip = None
+                    if strip is not None:
+                        overlays.append(self.overlays.centered(self.overlays.countdown(time_left), width, height))
+                        text = "{:d}/{:d}".format(strip.shots + 1, strip.count)
+                        overlays.append((self.overlays.text(text, size=40), 10, 10))
+                elif timer_active:
                     time_left = self.timer_limit - (time.time() - t0)
                     if time_left <= 0:
                         time_left = 0
                         trigger = True
-                    font_scale = 350 - 50 * (time_left - int(time_left))
-                    font = pygame.font.SysFont('freesans', int(font_scale), bold=True)
-                    text = "{:d}".format(int(time_left))
-                    overlay = font.render(text, 1, pygame.Color(255, 255, 255))
-                    w, h = overlay.get_size()
-                    overlays.append((overlay, int(width / 2.0 - w / 2.0), int(height / 2.0 - h / 2.0)))
+                    overlays.append(self.overlays.centered(self.overlays.countdown(time_left), width, height))
                 elif gif_buffer is not None:
-                    font = pygame.font.SysFont('freesans', 30, bold=True)
-                    text = "GIF record..."
-                    overlay_text = font.render(text, 1, pygame.Color(255, 0, 0, 128))
-                    overlay_box = pygame.Surface(self.screen.get_size(),
-                                                 flags=pygame.HWSURFACE | pygame.SRCALPHA)
-                    pygame.draw.rect(overlay_box, (255, 0, 0, 128),
-                                     pygame.Rect(0, 0,
-                                                 self.screen.get_size()[0],
-                                                 self.screen.get_size()[1]),
-                                     15)
-                    overlays.append((overlay_text, 10, 10))
-                    overlays.append((overlay_box, 0, 0))
+                    overlays.append((self.overlays.text("GIF record...", color=(255, 0, 0, 128)), 10, 10))
+                    overlays.append((self.overlays.frame((255, 0, 0, 128)), 0, 0))
                     # cv2.rectangle(img_preview, (0, 0), (img_preview.shape[1], img_preview.shape[0]), (0, 0, 255), 5)
                 elif info:
                     self.log.debug("Show info text")
-                    font = pygame.font.SysFont('freesans', 18, bold=True)
                     text = "INFO | 3...2...1...cheeese! | animated GIF | Print last image"
-                    overlays.append((font.render(text, 1, pygame.Color(255, 255, 255)), 0, 0))
+                    overlays.append((self.overlays.text(text, size=18), 0, 0))
+
+                if time.time() - t_metrics >= METRICS_INTERVAL:
+                    t_metrics = time.time()
+                    try:
+                        current_fps = float(fps.fps())
+                    except (TypeError, ZeroDivisionError):
+                        current_fps = 0.0
+                    metrics_overlays = self.update_metrics(grabber, current_fps)
+                if show_metrics:
+                    overlays.extend(metrics_overlays)
 
                 if self.verbose:
-                    font = pygame.font.SysFont('freesans', 20, bold=True)
+                    stats = grabber.stats()
                     try:
                         text = "{:.2f} fps".format(float(fps.fps()))
                     except TypeError:
                         text = "0 fps"
-                    overlay = font.render(text, 1, pygame.Color(255, 255, 255))
+                    text += " | camera {:.2f} fps | {:d} dropped | {:d} duplicates | {:d} converted | {:d} saving".format(
+                        stats["capture_fps"], stats["dropped"], stats["duplicates"], self.display.conversions,
+                        self.persistence.depth)
+                    overlay = self.overlays.text(text, size=20)
                     w, h = overlay.get_size()
                     overlays.append((overlay, int(width - w), int(height - h)))
 
-                # display image
-                self.update_window(img_preview, overlays)
+                self.metrics.lap("overlays")
+
+                # display animation frame or image
+                frame, animation_overlays = self.animator.frame()
+                if frame is not None:
+                    self.update_window(frame, animation_overlays + overlays)
+                else:
+                    self.update_window(img, overlays)
+                if event is not None:
+                    # time from the press until the first frame after the action is on screen
+                    self.metrics.record("action_{}".format(action.value), time.perf_counter() - event.t)
                 # clear overlays
                 overlays.clear()
 
@@ -470,9 +781,18 @@ class Photobooth:
                 self.frame_count += 1
                 fps.update()
                 fps.stop()
-                self.log.debug("FPS: {}".format(fps.fps()))
+                self.metrics.record("frame", time.perf_counter() - t_frame)
             # cleanup
             self.log.info("cleanup")
+            self.log.info("display: {:d} frames, {:d} bytes of buffers, {:d} frames converted".format(
+                self.display.frames, self.display.buffer_bytes, self.display.conversions))
+            self.bus.unsubscribe(grabber.ring.wake)
+            if gif_buffer is not None:
+                gif_buffer.abort()
+            if last_gif is not None:
+                last_gif.join()
+            capture.close()
+            grabber.stop()
             camera.close()
             pygame.quit()
         return 0
@@ -482,12 +802,27 @@ class Photobooth:
         w, h = self.screen.get_size()
         return w
 
-    def get_action(self):
+    def start_trace(self, kind, event, handled):
+        """
+        Starts the trace of a capture at the press of its input event
+        :param kind: event name
+        :param event: InputEvent
+        :param handled: perf_counter() time the preview loop took the event
+        :return: Trace
+        """
+        trace = self.tracer.start(kind, event.t)
+        trace.add("input", event.t, handled)
+        self.log.info("trace {}".format(trace))
+        return trace
+
+    def get_event(self):
+        """
+        Polls the input sources that need it and takes the oldest pending event
+        :return: InputEvent or None
+        """
         for handler in self.input_handler:
-            action = handler.get_action()
-            if action is not Action.none:
-                return action
-        return Action.none
+            handler.poll()
+        return self.bus.get()
 
     def preview(self, block=True):
         if block:
@@ -541,7 +876,7 @@ class Photobooth:
         return True
 
     def get_image_name(self, file_type="jpg"):
-        return "{}.{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), file_type)
+        return self.image_names.reserve(file_type)
 
     @property
     def path_images(self):
@@ -557,20 +892,87 @@ class Photobooth:
             os.mkdir(path)
         return path
 
-    def create_thumb(self, path):
+    def save_photo(self, img, path, jpeg=None, trace=None):
+        """
+        Saves a captured photo and publishes its thumbnail, runs in the persistence queue
+        :param img: BGR image, full resolution or at least thumbnail size if jpeg is given
+        :param path: image path
+        :param jpeg: original JPEG of the camera, saved instead of encoding img
+        :param trace: Trace of the capture, finished once the thumbnail is published
+        """
+        if trace is not None:
+            trace.since_last("queue")
+        self.log.info("save image to {}".format(path))
+        t = time.perf_counter()
+        write_atomic(path, jpeg if jpeg is not None else encode_jpeg(img))
+        if trace is not None:
+            trace.add("write", t)
+        self.create_thumb(path, img, trace)
+
+    def _strip_shot(self, strip, index, path, jpeg, img):
+        """
+        Saves a shot of a strip and composes the strip once all shots arrived, runs in the capture thread
+        """
+        self.persistence.submit(self.save_photo, img, path, jpeg)
+        if strip.add(index, img):
+            strip.trace.since_last("capture")
+            self.persistence.submit(self.save_strip, strip)
+
+    def _gif_saved(self, trace, path):
+        trace.since_last("encode")
+        self.publish(path, trace)
+
+    def save_strip(self, strip):
+        """
+        Composes, saves and publishes a finished strip and queues it for review, runs in the persistence queue
+        :param strip: StripSession with all frames
+        """
+        strip.trace.since_last("queue")
+        with strip.trace.span("compose"):
+            img = compose_strip(strip.frames)
+        self.log.info("save strip to {} ({:.1f} s after the start)".format(strip.path, time.time() - strip.started))
+        with strip.trace.span("write"):
+            write_atomic(strip.path, encode_jpeg(img))
+        self.create_thumb(strip.path, img, strip.trace)
+        self.reviews.put(img)
+
+    def create_thumb(self, path, img=None, trace=None):
+        """
+        Writes and publishes the thumbnail of an image
+        :param path: image path
+        :param img: the image if it is in memory, otherwise it is read from path
+        :param trace: Trace of the capture, finished once the thumbnail is published
+        """
         self.log.info("creating thumbnail for {}".format(path))
+        t = time.perf_counter()
         basename = os.path.basename(path)
-        img = cv2.imread(path)
-
-        # if img.shape[1] < self.thumb_width:
-        #     cv2.imwrite(img, os.path.join(self.path_thumbs, basename))
-        #     return
-        # factor = self.thumb_width / float(img.shape[1])
-        # resized = cv2.resize(img, None, fx=factor, fy=factor)
-        resized = resize(img, width=self.thumb_width)
+        if img is None:
+            img = cv2.imread(path)
+        resized = resize_width(img, self.thumb_width)
         thumbnail_path = os.path.join(self.path_thumbs, basename)
         self.log.info("save thumbail to {}".format(thumbnail_path))
-        cv2.imwrite(thumbnail_path, resized)
+        write_atomic(thumbnail_path, encode_jpeg(resized))
+        if trace is not None:
+            trace.add("thumbnail", t)
+        self.publish(thumbnail_path, trace)
+
+    def publish(self, thumbnail_path, trace=None):
+        """
+        Adds a written thumbnail to the gallery index of the photoserver
+        and encodes its WebP/AVIF variants in background
+        :param thumbnail_path: path to thumbnail
+        :param trace: Trace of the capture, finished once the photoserver lists the thumbnail
+        """
+        t = time.perf_counter()
+        self.gallery.add(os.path.basename(thumbnail_path))
+        if trace is not None:
+            trace.add("publish", t)
+            trace.finish(name=os.path.basename(thumbnail_path))
+        self.variant_encoder.submit(thumbnail_path)
+
+    def _variants_written(self, thumbnail_path, formats):
+        if self.gallery.catalog is not None:
+            self.gallery.catalog.add_variants(os.path.basename(thumbnail_path), formats)
 
 
 class PhotoboothDefaultCam:
@@ -585,14 +987,25 @@ class PhotoboothDefaultCam:
         self.log.setLevel(logging.DEBUG if verbose else logging.INFO)
 
         self.camera = None
+        # held while the camera captures, preview and photo must not overlap
+        self.lock = Lock()
+        # Metrics of the preview loop, set by the Photobooth
+        self.metrics = None
 
         self.flash_pin = 13
         self.flash_default = 40
         self.flash_bright = 100
         self.pwm = None
+        self.setup_flash()
 
+    def setup_flash(self):
         # setup flash pin PWM
-        import RPi.GPIO as GPIO
+        try:
+            import RPi.GPIO as GPIO
+        except (ImportError, RuntimeError) as e:
+            # not on a Raspberry Pi, the flash is a no-op
+            self.log.warning("no GPIO for the flash: {}".format(e))
+            return
         GPIO.setmode(GPIO.BCM)  # we are programming the GPIO by BCM pin numbers. (PIN35 as ‘GPIO19’)
         GPIO.setup(self.flash_pin, GPIO.OUT)  # initialize GPIO19 as an output.
         # GPIO.output(self.flash_pin, True)
@@ -620,6 +1033,13 @@ class PhotoboothDefaultCam:
             img = cv2.flip(img, 0)
         return resize(img, width=self.preview_width)
 
+    def take_photo_jpeg(self):
+        """
+        Captures a photo as encoded by the camera
+        :return: JPEG bytes or None if the camera only delivers images, then use take_photo()
+        """
+        return None
+
     def take_photo(self):
         img = self.camera.read()
         self.log.debug(img.shape)
@@ -649,7 +1069,6 @@ class RaspiboothCam(PhotoboothDefaultCam):
 
     def __init__(self, *args, **kwargs):
         super(RaspiboothCam, self).__init__(*args, **kwargs)
-        self.lock = Lock()
 
         self.img = None
         self.camera = None
@@ -795,9 +1214,13 @@ class GPhotoboothCam(PhotoboothDefaultCam):
 
     def __init__(self, *args, **kwargs):
         super(GPhotoboothCam, self).__init__(*args, **kwargs)
+        # a capture that was not a JPEG, decoded by take_photo_jpeg() for take_photo()
+        self._decoded = None
 
     def init_camera(self):
+        import gphoto2 as gp
         self.log.debug("Init GPhoto2 camera")
+        self.decoder = PreviewDecoder(self.preview_width, metrics=self.metrics)
         callback_obj = gp.check_result(gp.use_python_logging())
         self.camera = gp.check_result(gp.gp_camera_new())
         gp.check_result(gp.gp_camera_init(self.camera))
@@ -826,27 +1249,121 @@ class GPhotoboothCam(PhotoboothDefaultCam):
         return True
 
     def close(self):
+        import gphoto2 as gp
         self.log.debug("close GPhoto2 camera")
         return gp.check_result(gp.gp_camera_exit(self.camera))
 
     def take_preview_image(self):
+        import gphoto2 as gp
         # self.log.debug("taking preview photo via GPhoto2")
         camera_file = gp.check_result(gp.gp_camera_capture_preview(self.camera))
         file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
-        # decode image
-        img = cv2.imdecode(np.fromstring(io.BytesIO(file_data).read(), np.uint8), 1)
-        return resize(img, width=self.preview_width)
+        # decode image from the gphoto buffer, scaled down by the decoder
+        return self.decoder.decode(file_data)
 
-    def take_photo(self):
-        import tempfile
+    def take_photo_jpeg(self):
+        import gphoto2 as gp
         self.log.info("Capturing image")
         file_path = gp.check_result(gp.gp_camera_capture(
             self.camera, gp.GP_CAPTURE_IMAGE))
         self.log.info("Camera file path: {0}/{1}".format(file_path.folder, file_path.name))
-        target = os.path.join(tempfile.gettempdir(), "tempfile.jpg")
-        self.log.info("Copying image to {}".format(target))
         camera_file = gp.check_result(gp.gp_camera_file_get(
             self.camera, file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL))
-        gp.check_result(gp.gp_file_save(camera_file, target))
-        img = cv2.imread(target)
+        # copy the file out of the gphoto buffer once, it is freed with camera_file
+        data = bytes(gp.check_result(gp.gp_file_get_data_and_size(camera_file)))
+        if data.startswith(SOI):
+            return data
+        self.log.warning("{} is not a JPEG, set the camera's image format to JPEG".format(file_path.name))
+        # e.g. a TIFF, saved as JPEG from the decoded image
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise IOError("cannot decode {}, set the camera's image format to JPEG".format(file_path.name))
+        self._decoded = img
+        return None
+
+    def take_photo(self):
+        img, self._decoded = self._decoded, None
+        if img is None:
+            data = self.take_photo_jpeg()
+            if data is None:
+                img, self._decoded = self._decoded, None
+            else:
+                img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
         return img
+
+
+class ReplayCam(PhotoboothDefaultCam):
+    """
+    Camera without hardware that replays frames of a video file, a directory
+    of JPEGs or a recorded MJPEG preview stream. The flash is a no-op.
+    """
+
+    def __init__(self, *args, source=None, fps=None, **kwargs):
+        """
+        :param source: path of the frames, synthetic frames if None
+        :param fps: preview frame rate or None for as fast as possible
+        """
+        self.source = source
+        self.fps = fps
+        self.img = None
+        self.data = None
+        self.decoder = None
+        # directory of the synthetic frames, removed by close()
+        self.frames_dir = None
+        super(ReplayCam, self).__init__(*args, **kwargs)
+
+    def setup_flash(self):
+        pass
+
+    def init_camera(self):
+        from photobooth.photobooth.replay import open_source, make_frames, EncodedSource
+        source = self.source
+        if source is None:
+            import tempfile
+            self.frames_dir = tempfile.mkdtemp(prefix="photobooth-replay-")
+            source = make_frames(self.frames_dir)
+        self.log.info("replay camera: {}".format(source))
+        self.camera = open_source(source, fps=self.fps)
+        if isinstance(self.camera, EncodedSource):
+            # JPEG previews are decoded like the ones of a gphoto2 camera
+            self.decoder = PreviewDecoder(self.preview_width, metrics=self.metrics)
+        return True
+
+    def close(self):
+        self.log.debug("close replay camera")
+        if self.camera is not None:
+            self.camera.close()
+        if self.frames_dir is not None:
+            import shutil
+            shutil.rmtree(self.frames_dir, ignore_errors=True)
+            self.frames_dir = None
+
+    def _flip(self, img):
+        if self.flip_h and self.flip_v:
+            return cv2.flip(img, -1)
+        elif self.flip_h:
+            return cv2.flip(img, 1)
+        elif self.flip_v:
+            return cv2.flip(img, 0)
+        return img
+
+    def take_preview_image(self):
+        if self.decoder is not None:
+            self.data = self.camera.read_bytes()
+            return self._flip(self.decoder.decode(self.data))
+        self.img = self._flip(self.camera.read())
+        return resize(self.img, width=self.preview_width)
+
+    def take_photo_jpeg(self):
+        # the JPEG of the last preview, like a camera without flips
+        if self.data is not None and not (self.flip_h or self.flip_v):
+            return self.data
+        return None
+
+    def take_photo(self):
+        # the full resolution frame of the last preview
+        if self.data is not None:
+            return self._flip(cv2.imdecode(np.frombuffer(self.data, np.uint8), cv2.IMREAD_COLOR))
+        if self.img is None:
+            self.img = self._flip(self.camera.read())
+        return self.img.copy()
@@ -1,5 +1,5 @@
 import argparse
-from photobooth.photobooth import Photobooth, Camera
+from photobooth.photobooth import Photobooth, Camera, Action
 
 
 if __name__ == "__main__":
@@ -9,11 +9,24 @@ if __name__ == "__main__":
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose', default=False)
     parser.add_argument('--server', action='store_true', help='Start HTTP server', default=False)
     parser.add_argument('--server-only', action='store_true', help='Start only HTTP server without camera', default=False)
+    parser.add_argument('--server-process', action='store_true', help='Run HTTP server in a separate process', default=False)
+    parser.add_argument('--server-host', type=str, help='HTTP server address', default="127.0.0.1")
+    parser.add_argument('--server-port', type=int, help='HTTP server port', default=5000)
+    parser.add_argument('--server-workers', type=int, help='HTTP server worker processes (with --server-process or --server-only)', default=1)
     parser.add_argument('--hflip', action='store_true', help='horizontal flip', default=False)
     parser.add_argument('--vflip', action='store_true', help='vertical flip', default=False)
     parser.add_argument('--image-dir', type=str, help='image directory', default="~")
     parser.add_argument('--thumb-width', type=int, help='thumbnail width', default=1280)
     parser.add_argument('--camera', type=Camera, choices=list(Camera), help='What camera interface?', default=Camera.gphoto2)
+    parser.add_argument('--replay-source', type=str, help='video, JPEG directory or MJPEG recording for --camera replay', default=None)
+    parser.add_argument('--replay-fps', type=float, help='frame rate of --camera replay (default: as fast as possible)', default=None)
+    parser.add_argument('--strip-length', type=int, help='photos per strip', default=4)
+    parser.add_argument('--strip-countdown', type=int, help='countdown before each photo of a strip in seconds', default=3)
+    parser.add_argument('--udp-port', type=int, help='accept actions like "photo" as UDP datagrams on this port', default=None)
+    parser.add_argument('--udp-host', type=str, help='address for --udp-port, 0.0.0.0 for all interfaces', default="127.0.0.1")
+    parser.add_argument('--udp-token', type=str, help='shared secret UDP datagrams have to start with, e.g. "secret photo"', default=None)
+    parser.add_argument('--udp-print', action='store_true', help='also accept print_last_photo as UDP datagram', default=False)
+    parser.add_argument('--gif-memory', type=int, help='MB of memory for the frames of a GIF recording, 0 keeps all frames and encodes them after the recording', default=64)
     parser.add_argument('--review-time', type=int, help='review time for snapshot in seconds', default=2)
 
     args = parser.parse_args()
@@ -23,15 +36,29 @@ if __name__ == "__main__":
                     fullscreen=args.fullscreen,
                     thumb_width=args.thumb_width,
                     review_time=args.review_time,
+                    gif_memory_budget=args.gif_memory * 1024 * 1024,
+                    strip_length=args.strip_length,
+                    strip_countdown=args.strip_countdown,
+                    udp_host=args.udp_host,
+                    udp_port=args.udp_port,
+                    udp_token=args.udp_token,
+                    udp_actions=[action for action in Action if action not in (Action.none, Action.exit)]
+                    if args.udp_print else None,
                     verbose=args.verbose,
-                    server=args.server,
+                    server=args.server and not args.server_only,
+                    server_mode="process" if args.server_process else "thread",
+                    server_host=args.server_host,
+                    server_port=args.server_port,
+                    server_workers=args.server_workers,
                     flip_h=args.hflip,
                     flip_v=args.vflip,
-                    cam_type=args.camera)
+                    cam_type=args.camera,
+                    replay_source=args.replay_source,
+                    replay_fps=args.replay_fps)
     if not args.server_only:
         pb.preview(block=True)
     else:
-        pb.run_server()
+        pb.run_server(workers=args.server_workers)
 
     # cleanup
     pb.close()
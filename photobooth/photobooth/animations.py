@@ -0,0 +1,163 @@
+import time
+import cv2
+import numpy as np
+
+# the blur of the review fades over this many frames
+BLUR_STEPS = 13
+# width the blur frames are computed at, the display scales them up
+BLUR_WIDTH = 320
+
+
+def resize_to(img, size):
+    """
+    Scales an image to fit (width, height), keeping the aspect ratio
+    """
+    width, height = size
+    factor = min(width / float(img.shape[1]), height / float(img.shape[0]))
+    if factor >= 1.0:
+        return img
+    return cv2.resize(img, (int(round(img.shape[1] * factor)), int(round(img.shape[0] * factor))),
+                      interpolation=cv2.INTER_AREA)
+
+
+class Animation:
+    """
+    Timeline of frames driven by the preview loop. frame() returns the frame
+    to show at a point in time or None when the animation is over.
+    """
+
+    def __init__(self, overlays=None, cancellable=True):
+        self.overlays = overlays if overlays is not None else []
+        self.cancellable = cancellable
+        self.t0 = None
+
+    @property
+    def duration(self):
+        raise NotImplementedError
+
+    def start(self, now=None):
+        self.t0 = time.time() if now is None else now
+
+    def frame(self, now):
+        elapsed = now - self.t0
+        if elapsed >= self.duration:
+            return None
+        return self._frame(elapsed)
+
+    def _frame(self, elapsed):
+        raise NotImplementedError
+
+
+class SnapReview(Animation):
+    """
+    White flash, the captured photo for review_time seconds, then the photo blurs away
+    """
+
+    def __init__(self, img, size, review_time=2, flash_time=0.2, blur_time=0.65, **kwargs):
+        """
+        :param img: captured photo
+        :param size: display size (width, height)
+        :param review_time: seconds the photo is shown
+        :param flash_time: seconds of white
+        :param blur_time: seconds of the blur
+        """
+        super(SnapReview, self).__init__(**kwargs)
+        self.flash_time = flash_time
+        self.review_time = review_time
+        self.blur_time = blur_time
+        # the display scales every frame, a tiny white image is enough for the flash
+        self.white = np.full((2, 2, 3), 255, dtype=np.uint8)
+        self.img = resize_to(img, size)
+        # all blur frames from one downscaled copy
+        small = resize_to(self.img, (BLUR_WIDTH, BLUR_WIDTH))
+        self.blurred = [cv2.blur(small, (k, k)) for k in range(1, 4 * BLUR_STEPS, 4)]
+
+    @property
+    def duration(self):
+        return self.flash_time + self.review_time + self.blur_time
+
+    def _frame(self, elapsed):
+        if elapsed < self.flash_time:
+            return self.white
+        elapsed -= self.flash_time
+        if elapsed < self.review_time:
+            return self.img
+        elapsed -= self.review_time
+        step = int(elapsed / self.blur_time * len(self.blurred))
+        return self.blurred[min(step, len(self.blurred) - 1)]
+
+
+class Flash(Animation):
+    """
+    White screen for a moment, e.g. for the shots of a strip
+    """
+
+    def __init__(self, flash_time=0.2, **kwargs):
+        super(Flash, self).__init__(**kwargs)
+        self.flash_time = flash_time
+        self.white = np.full((2, 2, 3), 255, dtype=np.uint8)
+
+    @property
+    def duration(self):
+        return self.flash_time
+
+    def _frame(self, elapsed):
+        return self.white
+
+
+class Playback(Animation):
+    """
+    Plays a list of frames with a fixed pause, repeated
+    """
+
+    def __init__(self, images, pause=0.3, repeat=5, **kwargs):
+        super(Playback, self).__init__(**kwargs)
+        self.images = images
+        self.pause = pause
+        self.repeat = repeat
+
+    @property
+    def duration(self):
+        return len(self.images) * self.pause * self.repeat
+
+    def _frame(self, elapsed):
+        return self.images[int(elapsed / self.pause) % len(self.images)]
+
+
+class Animator:
+    """
+    Runs one animation at a time on the frame clock of the preview loop
+    """
+
+    def __init__(self):
+        self.animation = None
+
+    @property
+    def active(self):
+        return self.animation is not None
+
+    def play(self, animation, now=None):
+        animation.start(now)
+        self.animation = animation
+
+    def cancel(self):
+        """
+        Stops the current animation if it may be interrupted
+        :return: True if an animation was stopped
+        """
+        if self.animation is not None and self.animation.cancellable:
+            self.animation = None
+            return True
+        return False
+
+    def frame(self, now=None):
+        """
+        :return: (frame, overlays) of the current animation or (None, []) if there is none
+        """
+        if self.animation is None:
+            return None, []
+        frame = self.animation.frame(time.time() if now is None else now)
+        if frame is None:
+            self.animation = None
+            return None, []
+        return frame, self.animation.overlays
@@ -0,0 +1,304 @@
+"""
+End-to-end benchmark of the preview loop without hardware.
+
+Runs Photobooth._preview() with the replay camera under SDL's dummy video
+driver and scripted input actions, then reports the sustained frame rate,
+per-stage timings, the latency of each action until its first frame is on
+screen and the memory growth over the run. For JPEG sources it first
+compares the preview decode time per frame of the old full-size decode and
+resize with the reduced decode of PreviewDecoder, and measures the bytes
+DisplayPipeline.show() allocates per frame with tracemalloc.
+
+    python -m photobooth.photobooth.benchmark --duration 300 --output preview.json
+    python -m photobooth.photobooth.benchmark --source preview.mjpg --decode-only
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from threading import Thread, Event
+
+# must be set before pygame opens the display
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import cv2
+import numpy as np
+import pygame
+from imutils import resize
+from photobooth.photobooth import Photobooth, Camera, Action, ScriptedInput
+from photobooth.photobooth.capture import PreviewDecoder
+from photobooth.photobooth.display import DisplayPipeline
+from photobooth.photobooth.replay import open_source, make_frames, EncodedSource
+
+# (seconds, action), repeated every SCRIPT_PERIOD seconds
+SCRIPT = ((5, Action.photo),
+          (6, Action.photo),
+          (7, Action.photo),
+          (15, Action.gif),
+          (35, Action.interval),
+          (45, Action.info),
+          (50, Action.info))
+SCRIPT_PERIOD = 60
+
+
+def parse_script(text):
+    """
+    Parses "5:photo,15:gif" into [(5.0, Action.photo), (15.0, Action.gif)]
+    """
+    script = []
+    for item in text.split(","):
+        at, action = item.split(":")
+        script.append((float(at), Action(action)))
+    return script
+
+
+def rss():
+    """
+    :return: resident set size of this process in bytes or None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+class MemorySampler:
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._t0 = time.time()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            value = rss()
+            if value is not None:
+                self.samples.append((time.time() - self._t0, value))
+            self._stop.wait(self.interval)
+
+    def report(self, warmup=10.0):
+        samples = [(t, v) for t, v in self.samples if t >= warmup] or self.samples
+        if len(samples) < 2:
+            return None
+        n = float(len(samples))
+        mean_t = sum(t for t, _ in samples) / n
+        mean_v = sum(v for _, v in samples) / n
+        var_t = sum((t - mean_t) ** 2 for t, _ in samples)
+        slope = sum((t - mean_t) * (v - mean_v) for t, v in samples) / var_t if var_t else 0.0
+        return dict(rss_start_mb=samples[0][1] / 1e6,
+                    rss_end_mb=samples[-1][1] / 1e6,
+                    rss_max_mb=max(v for _, v in samples) / 1e6,
+                    growth_mb=(samples[-1][1] - samples[0][1]) / 1e6,
+                    growth_mb_per_min=slope * 60 / 1e6)
+
+
+def decode_full(data, width):
+    """
+    Preview decode before PreviewDecoder: copy, full-size decode, resize
+    """
+    img = cv2.imdecode(np.frombuffer(io.BytesIO(data).read(), np.uint8).copy(), 1)
+    return resize(img, width=width)
+
+
+def decode_benchmark(frames, widths=(320, 480, 800), repeat=3):
+    """
+    Times both preview decodes for every frame of an encoded source
+    :param frames: list of JPEG bytes
+    :param widths: display widths
+    :param repeat: passes over all frames
+    :return: dict width -> dict(before_ms, after_ms, source and decoded size)
+    """
+    results = {}
+    for width in widths:
+        decoder = PreviewDecoder(width)
+        img = decoder.decode(frames[0])
+        timings = {}
+        for name, decode in (("before", lambda data: decode_full(data, width)), ("after", decoder.decode)):
+            t = time.perf_counter()
+            for i in range(repeat):
+                for data in frames:
+                    decode(data)
+            timings[name] = (time.perf_counter() - t) / (repeat * len(frames)) * 1000
+        results[width] = dict(before_ms=timings["before"],
+                              after_ms=timings["after"],
+                              source_width=decoder.source_width,
+                              decoded_width=img.shape[1])
+    return results
+
+
+def display_benchmark(screen_size=(800, 480), frame_size=(1056, 704), count=200):
+    """
+    Measures the memory DisplayPipeline.show() allocates per frame with tracemalloc,
+    for camera frames and for grayscale frames that are converted first
+    :param screen_size: (width, height) of the dummy screen
+    :param frame_size: (width, height) of the frames
+    :param count: frames shown per case
+    :return: dict case -> dict(bytes_per_frame, peak_bytes, retained_bytes)
+    """
+    pygame.display.init()
+    display = DisplayPipeline(pygame.display.set_mode(screen_size))
+    width, height = frame_size
+    frame = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    results = {}
+    for case, img in (("bgr", frame), ("gray", cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))):
+        # first frame outside the measurement, e.g. OpenCV's lazy initialization
+        display.show(img)
+        allocated = peak = 0
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            display.show(img)
+            frame_peak = tracemalloc.get_traced_memory()[1] - before
+            allocated += frame_peak
+            peak = max(peak, frame_peak)
+        retained = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        results[case] = dict(bytes_per_frame=allocated / float(count),
+                             peak_bytes=peak,
+                             retained_bytes=retained)
+    pygame.display.quit()
+    return results
+
+
+def benchmark(source=None, fps=None, duration=120.0, script=SCRIPT, period=SCRIPT_PERIOD, image_dir=None,
+              review_time=2):
+    """
+    Runs the preview loop with the replay camera
+    :return: report dict
+    """
+    base_dir = image_dir or tempfile.mkdtemp(prefix="photobooth-bench-")
+    os.makedirs(base_dir, exist_ok=True)
+    scripted = ScriptedInput(script, repeat=period)
+    pb = Photobooth(image_dir=base_dir,
+                    review_time=review_time,
+                    input_handler=[scripted],
+                    server=False,
+                    cam_type=Camera.replay,
+                    replay_source=source,
+                    replay_fps=fps)
+    memory = MemorySampler()
+    try:
+        stop = Thread(target=lambda: (time.sleep(duration), pb.event.set()), daemon=True)
+        memory.start()
+        t0 = time.time()
+        stop.start()
+        pb.preview(block=True)
+        elapsed = time.time() - t0
+        memory.stop()
+        snapshot = pb.metrics.snapshot()
+        frames = pb.frame_count
+    finally:
+        pb.close()
+        if image_dir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    stages = {stage: summary for stage, summary in snapshot["stages"].items() if not stage.startswith("action_")}
+    actions = {stage[len("action_"):]: summary for stage, summary in snapshot["stages"].items()
+               if stage.startswith("action_")}
+    for action, lags in scripted.lags.items():
+        actions.setdefault(action.value, {})["input_lag_ms"] = max(lags) * 1000
+    return dict(duration=elapsed,
+                frames=frames,
+                fps=frames / elapsed if elapsed else 0.0,
+                stages=stages,
+                actions=actions,
+                gauges=snapshot["gauges"],
+                memory=memory.report())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preview loop benchmark with the replay camera')
+    parser.add_argument('--source', type=str, help='video, JPEG directory or MJPEG recording (default: synthetic)',
+                        default=None)
+    parser.add_argument('--fps', type=float, help='camera frame rate (default: as fast as possible)', default=None)
+    parser.add_argument('--duration', type=float, help='duration in seconds', default=120.0)
+    parser.add_argument('--script', type=str, help='actions like "5:photo,15:gif"', default=None)
+    parser.add_argument('--period', type=float, help='repeat the script every N seconds', default=SCRIPT_PERIOD)
+    parser.add_argument('--image-dir', type=str, help='keep captures in this directory', default=None)
+    parser.add_argument('--decode-widths', type=int, nargs='+', help='display widths of the decode benchmark',
+                        default=[320, 480, 800])
+    parser.add_argument('--decode-only', action='store_true', help='only run the decode benchmark', default=False)
+    parser.add_argument('--display-frames', type=int, help='frames of the display allocation benchmark',
+                        default=200)
+    parser.add_argument('--output', type=str, help='write JSON results to file', default=None)
+    args = parser.parse_args()
+
+    frames_dir = None
+    source = args.source
+    if source is None:
+        # the synthetic frames of the replay camera, like a DSLR live view
+        frames_dir = tempfile.mkdtemp(prefix="photobooth-frames-")
+        source = make_frames(frames_dir, width=1056, height=704)
+    decode = None
+    encoded = open_source(source)
+    if isinstance(encoded, EncodedSource):
+        decode = decode_benchmark(encoded.frames, args.decode_widths)
+        for width, d in sorted(decode.items()):
+            print("decode {:d} -> {:d} px: before {:6.2f} ms  after {:6.2f} ms per frame (decoded {:d} px)".format(
+                d["source_width"], width, d["before_ms"], d["after_ms"], d["decoded_width"]))
+    encoded.close()
+    display = None
+    if not args.decode_only:
+        display = display_benchmark(count=args.display_frames)
+        for case, d in sorted(display.items()):
+            print("display {:>4s}: {:9.0f} bytes allocated per frame, peak {:d}, {:d} retained after {:d} frames".format(
+                case, d["bytes_per_frame"], d["peak_bytes"], d["retained_bytes"], args.display_frames))
+    if args.decode_only:
+        if frames_dir is not None:
+            shutil.rmtree(frames_dir, ignore_errors=True)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(dict(decode=decode), f, indent=2)
+        return
+
+    report = benchmark(source=source,
+                       fps=args.fps,
+                       duration=args.duration,
+                       script=parse_script(args.script) if args.script else SCRIPT,
+                       period=args.period,
+                       image_dir=args.image_dir)
+    if frames_dir is not None:
+        shutil.rmtree(frames_dir, ignore_errors=True)
+    report["created"] = datetime.datetime.now().isoformat()
+    report["decode"] = decode
+    report["display"] = display
+
+    print("{:d} frames in {:.1f} s: {:.1f} fps".format(report["frames"], report["duration"], report["fps"]))
+    for stage, s in sorted(report["stages"].items()):
+        if s["p50_ms"] is not None:
+            print("    {:>10s}: p50 {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms".format(
+                stage, s["p50_ms"], s["p95_ms"], s["max_ms"]))
+    for action, s in sorted(report["actions"].items()):
+        if s.get("max_ms") is not None:
+            print("    {:>10s}: {:d}x  to screen p50 {:7.2f} ms  max {:7.2f} ms".format(
+                action, s["count"], s["p50_ms"], s["max_ms"]))
+    if report["memory"] is not None:
+        m = report["memory"]
+        print("    memory: {:.1f} -> {:.1f} MB, {:+.2f} MB/min".format(
+            m["rss_start_mb"], m["rss_end_mb"], m["growth_mb_per_min"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
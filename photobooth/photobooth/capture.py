@@ -0,0 +1,293 @@
+import io
+import logging
+import time
+from queue import Queue
+from threading import Thread, Condition, Event
+import cv2
+import numpy as np
+from PIL import Image
+from photobooth.photoserver.thumbnails import reduced_flags
+
+
+class FrameRing:
+    """
+    Small ring of preallocated frames shared by one producer and one consumer.
+
+    The producer copies every frame into a free slot, the consumer always gets
+    the newest one. The slot handed to the consumer is not overwritten until the
+    consumer asks for the next frame, so it can be rendered without a copy.
+    Frames the consumer never saw are counted as dropped, frames it got twice as
+    duplicates.
+    """
+
+    def __init__(self, size=3):
+        if size < 3:
+            raise ValueError("a ring needs at least 3 slots (reading, latest, writing)")
+        self.size = size
+        self._slots = [None] * size
+        self._cond = Condition()
+        # sequence number of the latest frame and its slot
+        self._seq = 0
+        self._latest = None
+        # slot leased to the consumer and the sequence number it read last
+        self._reading = None
+        self._read_seq = 0
+        self._closed = False
+
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    def _free_slot(self):
+        for i in range(1, self.size + 1):
+            slot = ((self._latest if self._latest is not None else -1) + i) % self.size
+            if slot != self._reading and slot != self._latest:
+                return slot
+
+    def write(self, frame):
+        """
+        Copies a frame into the ring
+        :param frame: numpy image
+        """
+        with self._cond:
+            slot = self._free_slot()
+            buffer = self._slots[slot]
+        # copy outside the lock, no one else touches a free slot
+        if buffer is None or buffer.shape != frame.shape or buffer.dtype != frame.dtype:
+            buffer = np.empty_like(frame)
+        np.copyto(buffer, frame)
+        with self._cond:
+            self._slots[slot] = buffer
+            if self._seq > self._read_seq:
+                # the previous frame was never read
+                self.dropped += 1
+            self._seq += 1
+            self._latest = slot
+            self.written += 1
+            self._cond.notify_all()
+
+    def latest(self, timeout=None):
+        """
+        Returns the newest frame. The frame stays valid until the next call.
+        :param timeout: seconds to wait for a frame newer than the last one read,
+                        None returns the newest frame immediately
+        :return: frame or None if there is no frame yet
+        """
+        with self._cond:
+            if timeout is not None and self._seq == self._read_seq and not self._closed:
+                self._cond.wait(timeout)
+            if self._latest is None:
+                return None
+            if self._seq == self._read_seq:
+                self.duplicates += 1
+            self._reading = self._latest
+            self._read_seq = self._seq
+            self.read += 1
+            return self._slots[self._reading]
+
+    def wake(self):
+        """
+        Ends a wait in latest() early, it returns the newest frame
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return dict(written=self.written, read=self.read, dropped=self.dropped, duplicates=self.duplicates)
+
+
+class PreviewGrabber:
+    """
+    Producer thread that captures preview frames of a camera backend into a FrameRing,
+    so the render loop never waits for the camera.
+
+    Every capture holds the camera lock; take the lock to use the camera from
+    another thread, e.g. for a full resolution photo.
+    """
+
+    def __init__(self, camera, ring_size=3, metrics=None):
+        """
+        :param camera: camera backend
+        :param ring_size: number of frame buffers
+        :param metrics: Metrics to record the capture time of each frame as stage "camera"
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.camera = camera
+        self.metrics = metrics
+        self.ring = FrameRing(ring_size)
+        self.error = None
+        self._stop = Event()
+        self._thread = None
+        self._t0 = None
+
+    def start(self, timeout=10.0):
+        """
+        Starts capturing and waits for the first frame
+        :param timeout: seconds to wait for the first frame
+        :return: True if a frame arrived
+        """
+        self._t0 = time.time()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self.ring.latest(timeout) is not None
+
+    def stop(self):
+        self._stop.set()
+        self.ring.close()
+        if self._thread is not None:
+            self._thread.join()
+        self.log.info("preview frames: {}".format(self.stats()))
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.camera.lock:
+                    t = time.perf_counter()
+                    img = self.camera.take_preview_image()
+                    if self.metrics is not None:
+                        self.metrics.record("camera", time.perf_counter() - t)
+            except Exception as e:
+                self.log.error("capturing preview failed: {}".format(e))
+                self.error = e
+                break
+            if img is None:
+                self.error = IOError("got no preview image")
+                self.log.error(self.error)
+                break
+            self.ring.write(img)
+        self.ring.close()
+
+    def latest(self, timeout=None):
+        return self.ring.latest(timeout)
+
+    def stats(self):
+        stats = self.ring.stats()
+        elapsed = time.time() - self._t0 if self._t0 is not None else 0
+        stats["capture_fps"] = stats["written"] / elapsed if elapsed > 0 else 0.0
+        return stats
+
+
+def decode_reduced(data, width):
+    """
+    Decodes a JPEG at the largest DCT scale that keeps it at least as wide as requested
+    :param data: JPEG bytes
+    :param width: minimum width
+    :return: BGR image or None
+    """
+    flags = cv2.IMREAD_COLOR
+    try:
+        # reads the header only
+        with Image.open(io.BytesIO(data)) as img:
+            flags, factor = reduced_flags(img.size[0], width)
+    except (IOError, SyntaxError):
+        pass
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+
+class PreviewDecoder:
+    """
+    Decodes preview JPEGs straight from the camera buffer at the smallest DCT
+    scale that is still at least as wide as the display, so the decoder does
+    most of the downscaling. The preview size is learned from the first frame.
+    """
+
+    def __init__(self, width, metrics=None):
+        """
+        :param width: target width
+        :param metrics: Metrics to record the decode time as stage "decode"
+        """
+        self.width = width
+        self.metrics = metrics
+        self.source_width = None
+        self.flags = cv2.IMREAD_COLOR
+
+    def decode(self, data):
+        """
+        :param data: JPEG bytes, memoryview or any other buffer
+        :return: BGR image at most as wide as the target width, or None
+        """
+        t = time.perf_counter()
+        # wraps the buffer, no copy
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        img = cv2.imdecode(buffer, self.flags)
+        if img is None:
+            return None
+        if self.source_width is None:
+            self.source_width = img.shape[1]
+            self.flags, factor = reduced_flags(self.source_width, self.width)
+        if img.shape[1] > self.width:
+            # less than a factor of 2 left after the DCT scaling
+            height = int(round(img.shape[0] * self.width / float(img.shape[1])))
+            img = cv2.resize(img, (self.width, height), interpolation=cv2.INTER_AREA)
+        if self.metrics is not None:
+            self.metrics.record("decode", time.perf_counter() - t)
+        return img
+
+
+class CaptureQueue:
+    """
+    Takes full resolution photos in a background thread, so downloading and
+    decoding a shot overlaps whatever the preview loop shows next, e.g. the
+    countdown of the following shot of a strip.
+
+    Every job captures with the flash on while holding the camera lock, then
+    decodes a copy at least `width` pixels wide (DCT-reduced for JPEG captures)
+    and calls its callback with the original JPEG bytes (or None) and the image.
+    """
+
+    def __init__(self, camera, width, maxsize=2):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.camera = camera
+        self.width = width
+        self.queue = Queue(maxsize=maxsize)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, callback):
+        """
+        Queues a capture, blocks while the queue is full
+        :param callback: called with (jpeg, img) in the capture thread
+        """
+        self.queue.put(callback)
+
+    def join(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            callback = self.queue.get()
+            if callback is None:
+                self.queue.task_done()
+                break
+            try:
+                self.camera.flash_on()
+                try:
+                    with self.camera.lock:
+                        jpeg = self.camera.take_photo_jpeg()
+                        img = self.camera.take_photo() if jpeg is None else None
+                finally:
+                    self.camera.flash_off()
+                if jpeg is not None:
+                    img = decode_reduced(jpeg, self.width)
+                if img is None:
+                    raise IOError("no image captured")
+                callback(jpeg, img)
+            except Exception as e:
+                self.log.error("capture failed: {}".format(e))
+            finally:
+                self.queue.task_done()
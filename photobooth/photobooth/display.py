@@ -0,0 +1,67 @@
+import logging
+import cv2
+import numpy as np
+import pygame
+
+
+class DisplayPipeline:
+    """
+    Shows BGR frames full-screen with one OpenCV pass per frame.
+
+    The screen size is read once. Every frame is scaled by cv2.resize() straight
+    into a preallocated buffer that backs a persistent pygame surface
+    (pygame.image.frombuffer, 'BGR' pixel format), so nothing is allocated per
+    frame. Pygame versions without 'BGR' get a second preallocated buffer for
+    the color swap. `buffer_bytes` is the size of these buffers, `conversions`
+    counts the frames that were not BGR and had to be converted first. The
+    allocations per frame are measured by benchmark.display_benchmark().
+    """
+
+    def __init__(self, screen):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.screen = screen
+        self.size = screen.get_size()
+        self.buffer_bytes = 0
+        self.conversions = 0
+        self.frames = 0
+
+        width, height = self.size
+        self._buffer = self._allocate((height, width, 3))
+        self._rgb = None
+        try:
+            self._surface = pygame.image.frombuffer(self._buffer, self.size, "BGR")
+        except ValueError:
+            # pygame < 2.1.3
+            self._rgb = self._allocate((height, width, 3))
+            self._surface = pygame.image.frombuffer(self._rgb, self.size, "RGB")
+        self.log.debug("display {}x{}, {:d} bytes of buffers".format(width, height, self.buffer_bytes))
+
+    def _allocate(self, shape, dtype=np.uint8):
+        buffer = np.empty(shape, dtype=dtype)
+        self.buffer_bytes += buffer.nbytes
+        return buffer
+
+    def show(self, frame):
+        """
+        Draws a frame on the screen, stretched to the full screen
+        :param frame: BGR image (grayscale images are converted)
+        """
+        if frame.ndim == 2 or frame.shape[2] != 3:
+            # not the camera format, conversion allocates
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR if frame.ndim == 2 else cv2.COLOR_BGRA2BGR)
+            self.conversions += 1
+        if frame.shape[1] == self.size[0] and frame.shape[0] == self.size[1]:
+            np.copyto(self._buffer, frame)
+        else:
+            cv2.resize(frame, self.size, dst=self._buffer, interpolation=cv2.INTER_LINEAR)
+        if self._rgb is not None:
+            cv2.cvtColor(self._buffer, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        self.screen.blit(self._surface, (0, 0))
+        self.frames += 1
+
+    def fill(self, color):
+        """
+        Fills the screen with a color, e.g. white for the flash
+        """
+        self.screen.fill(color)
+        self.frames += 1
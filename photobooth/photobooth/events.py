@@ -0,0 +1,69 @@
+import logging
+import time
+from collections import namedtuple
+from queue import Queue, Empty
+from threading import Lock
+
+# an action of an input source and the perf_counter() time it happened
+InputEvent = namedtuple("InputEvent", ("action", "source", "t"))
+
+
+class InputBus:
+    """
+    Thread-safe queue of the input events of all sources. Sources push from
+    any thread (key polling, GPIO edge callbacks, network listeners), the
+    preview loop takes the events in order. Nothing is dropped or coalesced.
+
+    Subscribers are called on every push, e.g. to wake up a loop that waits
+    for the next camera frame.
+    """
+
+    def __init__(self, metrics=None):
+        """
+        :param metrics: Metrics to record the time from push to handling as stage "input_latency"
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.metrics = metrics
+        self.queue = Queue()
+        self.pushed = 0
+        self._subscribers = []
+        self._lock = Lock()
+
+    def push(self, action, source, t=None):
+        """
+        :param action: Action
+        :param source: name of the input source
+        :param t: perf_counter() time of the event, now if None
+        """
+        event = InputEvent(action, source, time.perf_counter() if t is None else t)
+        self.queue.put(event)
+        with self._lock:
+            self.pushed += 1
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback()
+
+    def get(self):
+        """
+        :return: oldest pending InputEvent or None
+        """
+        try:
+            event = self.queue.get_nowait()
+        except Empty:
+            return None
+        if self.metrics is not None:
+            self.metrics.record("input_latency", time.perf_counter() - event.t)
+        return event
+
+    @property
+    def pending(self):
+        return self.queue.qsize()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+import pygame
+
+# rendered strings kept per cache, counters like the fps change every frame
+TEXT_CACHE_SIZE = 256
+# the countdown digit shrinks from 350 to 300 px each second, rendered in this many steps
+COUNTDOWN_STEPS = 10
+
+
+class OverlayCache:
+    """
+    Fonts, rendered text and static overlay surfaces of the preview window.
+
+    Fonts are looked up once per (name, size, bold), text is rendered once per
+    string and style, and full-screen frames are drawn once per screen size.
+    Only surfaces that depend on the screen size are dropped when it changes.
+    """
+
+    def __init__(self, screen_size=None):
+        self._fonts = {}
+        self._texts = OrderedDict()
+        self._frames = {}
+        self._countdown = {}
+        self.screen_size = screen_size
+
+    def resize(self, screen_size):
+        """
+        Invalidates the surfaces that depend on the screen size
+        :param screen_size: (width, height)
+        """
+        if screen_size != self.screen_size:
+            self._frames.clear()
+            self.screen_size = screen_size
+
+    def font(self, name, size, bold=False):
+        key = (name, int(size), bold)
+        font = self._fonts.get(key)
+        if font is None:
+            font = self._fonts[key] = pygame.font.SysFont(name, int(size), bold=bold)
+        return font
+
+    def text(self, text, name="freesans", size=30, color=(255, 255, 255), bold=True):
+        """
+        Renders antialiased text
+        :return: Surface
+        """
+        key = (text, name, int(size), bold, tuple(color))
+        surface = self._texts.get(key)
+        if surface is None:
+            surface = self.font(name, size, bold).render(text, 1, pygame.Color(*color))
+            self._texts[key] = surface
+            while len(self._texts) > TEXT_CACHE_SIZE:
+                self._texts.popitem(last=False)
+        else:
+            self._texts.move_to_end(key)
+        return surface
+
+    def frame(self, color, width=15):
+        """
+        Returns a transparent full-screen surface with a colored border
+        :param color: RGBA color
+        :param width: border width
+        :return: Surface
+        """
+        key = (tuple(color), width)
+        surface = self._frames.get(key)
+        if surface is None:
+            surface = pygame.Surface(self.screen_size, flags=pygame.HWSURFACE | pygame.SRCALPHA)
+            pygame.draw.rect(surface, color, pygame.Rect(0, 0, self.screen_size[0], self.screen_size[1]), width)
+            self._frames[key] = surface
+        return surface
+
+    def countdown(self, time_left):
+        """
+        Returns the sprite of the countdown digit, shrinking within each second
+        :param time_left: seconds left
+        :return: Surface
+        """
+        fraction = time_left - int(time_left)
+        step = min(int(fraction * COUNTDOWN_STEPS), COUNTDOWN_STEPS - 1)
+        key = (int(time_left), step)
+        surface = self._countdown.get(key)
+        if surface is None:
+            size = 350 - 50 * step / float(COUNTDOWN_STEPS)
+            surface = self._countdown[key] = self.font("freesans", size, True).render(
+                "{:d}".format(int(time_left)), 1, pygame.Color(255, 255, 255))
+        return surface
+
+    def prerender_countdown(self, limit):
+        """
+        Renders all countdown sprites of a timer up front
+        :param limit: timer length in seconds
+        """
+        for second in range(int(limit) + 1):
+            for step in range(COUNTDOWN_STEPS):
+                self.countdown(second + (step + 0.5) / COUNTDOWN_STEPS)
+
+    @staticmethod
+    def centered(surface, width, height):
+        """
+        :return: overlay tuple (surface, x, y) centered in an area of width x height
+        """
+        w, h = surface.get_size()
+        return surface, int(width / 2.0 - w / 2.0), int(height / 2.0 - h / 2.0)
@@ -0,0 +1,162 @@
+import datetime
+import logging
+import os
+import tempfile
+from queue import Queue
+from threading import Thread, Lock
+import cv2
+
+
+# captures are named after the second they were taken in
+NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+def write_atomic(path, data):
+    """
+    Writes a file via a hidden temporary file and a rename, so readers never see partial files.
+    Every call gets its own temporary file, concurrent writers of a path never share one.
+    :param path: target path
+    :param data: bytes or numpy buffer
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".{}.".format(os.path.basename(path)),
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp creates files only the owner can read
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ImageNames:
+    """
+    Unique file names of captures. Names are the capture time, a capture in the
+    same second as an earlier one gets a -2, -3, ... suffix. A name counts as
+    taken as soon as it is handed out, before its file is written.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory of the captures
+        """
+        self.directory = directory
+        self._lock = Lock()
+        self._stem = None
+        self._reserved = set()
+
+    def reserve(self, file_type="jpg", now=None):
+        """
+        :param file_type: file extension
+        :param now: capture time, datetime.now() if None
+        :return: file name
+        """
+        stem = (datetime.datetime.now() if now is None else now).strftime(NAME_FORMAT)
+        with self._lock:
+            if stem != self._stem:
+                # names of earlier seconds can't collide any more
+                self._stem = stem
+                self._reserved.clear()
+            name = "{}.{}".format(stem, file_type)
+            count = 1
+            while name in self._reserved or os.path.exists(os.path.join(self.directory, name)):
+                count += 1
+                name = "{}-{:d}.{}".format(stem, count, file_type)
+            self._reserved.add(name)
+            return name
+
+
+def encode_jpeg(img, quality=None):
+    """
+    :param img: BGR image
+    :param quality: JPEG quality or None for the OpenCV default
+    :return: encoded bytes
+    """
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality is not None else []
+    ok, data = cv2.imencode(".jpg", img, params)
+    if not ok:
+        raise IOError("JPEG encoding failed")
+    return data.tobytes()
+
+
+def resize_width(img, width):
+    """
+    Resizes an image to a width, keeping the aspect ratio
+    """
+    height = int(round(img.shape[0] * width / float(img.shape[1])))
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+class PersistenceQueue:
+    """
+    Bounded queue of jobs that save captures, run by a pool of worker threads.
+
+    submit() blocks while the queue is full, so a burst of captures slows the
+    capture loop down instead of piling up frames in memory. depth is the
+    number of queued and running jobs.
+    """
+
+    def __init__(self, workers=2, maxsize=4):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.queue = Queue(maxsize=maxsize)
+        self._lock = Lock()
+        self._depth = 0
+        self._closed = False
+        self.threads = [Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        with self._lock:
+            return self._depth
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a job, blocks while the queue is full
+        :param function: job function
+        """
+        with self._lock:
+            self._depth += 1
+            depth = self._depth
+        self.log.debug("queue depth {:d}".format(depth))
+        self.queue.put((function, args, kwargs))
+
+    def join(self):
+        """
+        Waits until all submitted jobs are done
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Finishes all submitted jobs and stops the workers
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        # one stop job per worker, a worker that took its stop job may exit before the others got theirs
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            function, args, kwargs = job
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                self.log.error("saving failed: {}".format(e))
+            finally:
+                with self._lock:
+                    self._depth -= 1
+                self.queue.task_done()
@@ -0,0 +1,150 @@
+import logging
+import os
+import time
+import cv2
+import numpy as np
+
+MJPEG_TYPES = (".mjpg", ".mjpeg")
+JPEG_TYPES = (".jpg", ".jpeg")
+SOI = b"\xff\xd8\xff"
+
+
+def split_mjpeg(data):
+    """
+    Splits a stream of concatenated JPEGs, e.g. recorded with
+    gphoto2 --capture-movie --stdout > preview.mjpg
+    :param data: stream bytes
+    :return: list of JPEG bytes
+    """
+    starts = []
+    i = data.find(SOI)
+    while i >= 0:
+        starts.append(i)
+        i = data.find(SOI, i + 1)
+    return [data[start:end] for start, end in zip(starts, starts[1:] + [len(data)])]
+
+
+class FrameSource:
+    """
+    Endless sequence of camera frames, optionally paced to a frame rate.
+    Encoded sources keep the JPEG bytes and decode every frame, like a camera preview.
+    """
+
+    def __init__(self, fps=None):
+        """
+        :param fps: frame rate or None to deliver frames as fast as possible
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.interval = 1.0 / fps if fps else 0.0
+        self._next = None
+
+    def _wait(self):
+        if not self.interval:
+            return
+        now = time.perf_counter()
+        if self._next is None or self._next < now - self.interval:
+            # first frame or too late, don't try to catch up
+            self._next = now
+        elif self._next > now:
+            time.sleep(self._next - now)
+        self._next += self.interval
+
+    def read(self):
+        """
+        :return: next BGR frame
+        """
+        self._wait()
+        return self._read()
+
+    def _read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class EncodedSource(FrameSource):
+    """
+    JPEG frames from a directory of JPEG files or an MJPEG recording
+    """
+
+    def __init__(self, path, fps=None):
+        super(EncodedSource, self).__init__(fps)
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.lower().endswith(JPEG_TYPES))
+            self.frames = []
+            for name in names:
+                with open(os.path.join(path, name), "rb") as f:
+                    self.frames.append(f.read())
+        else:
+            with open(path, "rb") as f:
+                self.frames = split_mjpeg(f.read())
+        if not len(self.frames):
+            raise IOError("no JPEG frames in {}".format(path))
+        self.log.info("replaying {:d} JPEG frames from {}".format(len(self.frames), path))
+        self.index = 0
+
+    def read_bytes(self):
+        """
+        :return: next JPEG frame, encoded
+        """
+        self._wait()
+        return self._next_bytes()
+
+    def _next_bytes(self):
+        data = self.frames[self.index]
+        self.index = (self.index + 1) % len(self.frames)
+        return data
+
+    def _read(self):
+        return cv2.imdecode(np.frombuffer(self._next_bytes(), np.uint8), cv2.IMREAD_COLOR)
+
+
+class VideoSource(FrameSource):
+    """
+    Frames of a video file, looped
+    """
+
+    def __init__(self, path, fps=None):
+        super(VideoSource, self).__init__(fps)
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError("can't open video {}".format(path))
+
+    def _read(self):
+        ok, frame = self.capture.read()
+        if not ok:
+            # rewind
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+            if not ok:
+                raise IOError("can't read video {}".format(self.path))
+        return frame
+
+    def close(self):
+        self.capture.release()
+
+
+def open_source(path, fps=None):
+    """
+    Opens a frame source by path: a directory of JPEGs, an MJPEG recording or a video file
+    """
+    if os.path.isdir(path) or path.lower().endswith(MJPEG_TYPES + JPEG_TYPES):
+        return EncodedSource(path, fps)
+    return VideoSource(path, fps)
+
+
+def make_frames(path, count=60, width=1024, height=680, seed=0):
+    """
+    Writes a directory of synthetic JPEG frames, a moving noise pattern
+    :return: path
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(path, exist_ok=True)
+    # smooth noise compresses like a photo, not like a flat color
+    base = cv2.resize(rng.randint(0, 255, (height // 8, width // 4, 3)).astype(np.uint8), (width * 2, height))
+    for i in range(count):
+        shift = int(width * i / float(count))
+        cv2.imwrite(os.path.join(path, "frame_{:04d}.jpg".format(i)), base[:, shift:shift + width])
+    return path
@@ -0,0 +1,85 @@
+import time
+from threading import Lock
+import cv2
+import numpy as np
+
+# width of each photo in the strip
+STRIP_FRAME_WIDTH = 1200
+STRIP_MARGIN = 40
+
+
+def compose_strip(frames, frame_width=STRIP_FRAME_WIDTH, margin=STRIP_MARGIN, background=255):
+    """
+    Stacks photos vertically on a plain background
+    :param frames: list of BGR images
+    :param frame_width: width of each photo in the strip
+    :param margin: border around and between the photos
+    :param background: background gray value
+    :return: BGR image
+    """
+    resized = []
+    for img in frames:
+        height = int(round(img.shape[0] * frame_width / float(img.shape[1])))
+        interpolation = cv2.INTER_AREA if img.shape[1] > frame_width else cv2.INTER_LINEAR
+        resized.append(cv2.resize(img, (frame_width, height), interpolation=interpolation))
+    height = sum(img.shape[0] for img in resized) + margin * (len(resized) + 1)
+    strip = np.full((height, frame_width + 2 * margin, 3), background, dtype=np.uint8)
+    y = margin
+    for img in resized:
+        strip[y:y + img.shape[0], margin:margin + frame_width] = img
+        y += img.shape[0] + margin
+    return strip
+
+
+class StripSession:
+    """
+    Timing of the shots of a photo strip and the frames that arrived so far.
+    Shots are taken by the preview loop, frames arrive from the capture thread.
+    """
+
+    def __init__(self, count=4, countdown=3.0, path=None, trace=None):
+        """
+        :param count: number of photos
+        :param countdown: seconds before each photo
+        :param path: path of the composed strip
+        :param trace: Trace of the strip
+        """
+        self.count = count
+        self.countdown = countdown
+        self.path = path
+        self.trace = trace
+        self.shots = 0
+        self.started = self.t0 = time.time()
+        self.frames = [None] * count
+        self.received = 0
+        self.lock = Lock()
+
+    def time_left(self, now=None):
+        """
+        :return: seconds until the next shot
+        """
+        return self.countdown - ((time.time() if now is None else now) - self.t0)
+
+    @property
+    def shooting(self):
+        return self.shots < self.count
+
+    def shoot(self, now=None):
+        """
+        Starts the next shot and the countdown of the one after it
+        :return: index of the shot
+        """
+        index = self.shots
+        self.shots += 1
+        self.t0 = time.time() if now is None else now
+        return index
+
+    def add(self, index, img):
+        """
+        Adds the frame of a shot
+        :return: True if this was the last missing frame
+        """
+        with self.lock:
+            self.frames[index] = img
+            self.received += 1
+            return self.received == self.count
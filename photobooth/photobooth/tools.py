@@ -1,13 +1,46 @@
+import io
+import logging
+import math
 import os
-import cv2
-import shutil
-import imageio
-import time
 import tempfile
+import time
+import cv2
+import numpy as np
+from PIL import Image, GifImagePlugin
+from queue import Queue, Empty, Full
 from threading import Thread
+from photobooth.photobooth.persistence import write_atomic
+
+# width of the frames the shared GIF palette is computed from
+PALETTE_SAMPLE_WIDTH = 160
+# frames the palette of a streaming GIF is computed from before its encoding starts
+PALETTE_FRAMES = 3
+# browsers play shorter GIF frame delays at 100 ms
+MIN_FRAME_DURATION = 20
+# bytes a streaming GIF recording may keep in memory
+GIF_MEMORY_BUDGET = 64 * 1024 * 1024
+# recorded frames waiting for the streaming encoder
+STREAM_QUEUE_SIZE = 2
+# seconds the encoder waits for a frame before it checks whether the recording ended
+STREAM_POLL_INTERVAL = 0.1
+
+
+def shared_palette(frames):
+    """
+    :param frames: RGB images of the same size
+    :return: palette image of one median cut over small copies of all frames
+    """
+    width, height = frames[0].size
+    size = (PALETTE_SAMPLE_WIDTH, max(1, int(round(height * PALETTE_SAMPLE_WIDTH / float(width)))))
+    sample = np.vstack([np.asarray(frame.resize(size, Image.Resampling.BOX)) for frame in frames])
+    return Image.fromarray(sample).quantize(colors=256, method=Image.Quantize.MEDIANCUT)
 
 
 class GIFCreator:
+    """
+    Records all frames of a GIF in memory and encodes them at once, with one
+    palette of all frames. StreamingGIFCreator encodes while recording instead.
+    """
 
     def __init__(self, size=5, pause=0):
         self._image_buffer = []
@@ -19,32 +52,69 @@ class GIFCreator:
         self.thread = None
 
     def __del__(self):
-        if self.thread is not None and self.thread.isAlive():
-            self.thread.join()
+        self.join()
 
     def update(self, image):
         t = time.time()
-        print(t - self._last, self._pause)
         if t - self._last > self._pause:
-            self._image_buffer.append(image)
+            # preview frames are reused buffers
+            self._image_buffer.append(image.copy())
             self._last = t
 
-    def save_to(self, path):
-        # imageio.mimsave(path, self._image_buffer)
-        self.thread = Thread(target=self._save, args=(path,))
+    @property
+    def duration(self):
+        """
+        :return: display time of each frame in ms, the pause between the recorded frames
+        """
+        return max(int(round(self._pause * 1000)), MIN_FRAME_DURATION)
+
+    def save_to(self, path, thumb_path=None, thumb_width=None, callback=None):
+        """
+        Saves in a background thread, see save()
+        """
+        self.thread = Thread(target=self.save, args=(path, thumb_path, thumb_width, callback))
         self.thread.start()
 
-    def _save(self, path):
-        # imageio.mimsave(path, self._image_buffer)
-        # tmpfile = os.path.join(tempfile.gettempdir(), os.path.basename(path))
-        tmpfile = tempfile.NamedTemporaryFile()
-        tmpfile.name = tmpfile.name + ".gif"
-        print("writing GIF to {}".format(tmpfile.name))
-        with imageio.get_writer(tmpfile.name, mode='I', duration=len(self._image_buffer)/20.0) as writer:
-            for img in self._image_buffer:
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                writer.append_data(img_rgb)
-        shutil.move(tmpfile.name, path)
+    def join(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+
+    def abort(self):
+        """
+        Ends the recording and drops the recorded frames, a started save is not stopped
+        """
+        self._image_buffer = []
+
+    def save(self, path, thumb_path=None, thumb_width=None, callback=None):
+        """
+        Encodes the GIF and a smaller thumbnail GIF in one pass. All frames of
+        both share one palette, which is computed once from all frames, so
+        consecutive frames only differ where the scene changed and the encoder
+        stores just the changed region of each frame. Both files are written atomically.
+        :param path: GIF path
+        :param thumb_path: thumbnail GIF path or None
+        :param thumb_width: width of the thumbnail GIF, at most the frame width
+        :param callback: called with thumb_path (or path) after both are written
+        """
+        frames = [Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)) for img in self._image_buffer]
+        palette = shared_palette(frames)
+        write_atomic(path, self._encode([frame.quantize(palette=palette, dither=Image.Dither.NONE)
+                                         for frame in frames]))
+        if thumb_path is not None:
+            width, height = frames[0].size
+            if thumb_width is not None and thumb_width < width:
+                size = (thumb_width, int(round(height * thumb_width / float(width))))
+                frames = [frame.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0) for frame in frames]
+            write_atomic(thumb_path, self._encode([frame.quantize(palette=palette, dither=Image.Dither.NONE)
+                                                   for frame in frames]))
+        if callback is not None:
+            callback(thumb_path if thumb_path is not None else path)
+
+    def _encode(self, frames):
+        buffer = io.BytesIO()
+        frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:],
+                       duration=self.duration, loop=0, optimize=False)
+        return buffer.getvalue()
 
     @property
     def images(self):
@@ -55,3 +125,238 @@ class GIFCreator:
 
     def __len__(self):
         return self._image_buffer.__len__()
+
+
+class GIFStream:
+    """
+    GIF file written frame by frame. Every frame after the first only stores
+    the region that changed, so all frames have to use the palette of the first.
+    The file is written to a hidden temporary file and renamed by close().
+    """
+
+    def __init__(self, path, duration):
+        """
+        :param path: GIF path
+        :param duration: display time of each frame in ms
+        """
+        self.path = path
+        self.duration = duration
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                             prefix=".{}.".format(os.path.basename(path)), suffix=".tmp")
+        os.chmod(self.tmp_path, 0o644)
+        self.file = os.fdopen(fd, "wb")
+        self.previous = None
+
+    def add(self, frame):
+        """
+        :param frame: "P" image
+        """
+        indices = np.asarray(frame)
+        if self.previous is None:
+            header, _ = GifImagePlugin.getheader(frame, info=dict(loop=0, duration=self.duration, optimize=False))
+            self.file.write(b"".join(header))
+            box = (0, 0) + frame.size
+        else:
+            changed = indices != self.previous
+            rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            if len(rows):
+                box = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+            else:
+                # nothing changed, a single pixel keeps the frame and its duration
+                box = (0, 0, 1, 1)
+            frame = frame.crop(box)
+        self.file.write(b"".join(GifImagePlugin.getdata(frame, offset=box[:2], duration=self.duration)))
+        self.previous = indices
+
+    def close(self):
+        self.file.write(b";")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class StreamingGIFCreator:
+    """
+    Records a GIF while it is being encoded. Each recorded frame is scaled down
+    and handed to a worker thread. The worker computes the palette of the GIF
+    from the first PALETTE_FRAMES frames, then maps every frame to it and
+    appends it to the GIF and the thumbnail GIF on disk. Both are ready right
+    after the last frame is recorded.
+
+    The recording keeps scaled copies of its frames for the playback and at most
+    STREAM_QUEUE_SIZE + PALETTE_FRAMES frames for the encoder, all of them sized
+    to fit memory_budget.
+    The preview loop never waits for the encoder: a frame that finds the queue
+    full is dropped and counted in `dropped`, the next frame after the pause
+    is recorded instead.
+    """
+
+    def __init__(self, path, thumb_path=None, size=5, pause=0, width=None, thumb_width=None,
+                 memory_budget=GIF_MEMORY_BUDGET, callback=None):
+        """
+        :param path: GIF path
+        :param thumb_path: thumbnail GIF path or None
+        :param size: number of frames
+        :param pause: seconds between recorded frames, also their display time
+        :param width: maximum width of the GIF, the frame width if None
+        :param thumb_width: width of the thumbnail GIF
+        :param memory_budget: bytes of frames in memory
+        :param callback: called with thumb_path (or path) when both GIFs are written
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.thumb_path = thumb_path
+        self._size = size
+        self._pause = pause
+        self.width = width
+        self.thumb_width = thumb_width
+        self.memory_budget = memory_budget
+        self.callback = callback
+        self.palette_frames = max(1, min(size, PALETTE_FRAMES))
+        # every frame in memory gets the same share of the budget
+        self.frame_budget = memory_budget // (size + STREAM_QUEUE_SIZE + self.palette_frames)
+        self._images = []
+        self._last = 0
+        self.dropped = 0
+        self.ended = False
+        self.aborted = False
+        self.error = None
+        self._gif = self._thumb = None
+
+        self.queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def duration(self):
+        """
+        :return: display time of each frame in ms, the pause between the recorded frames
+        """
+        return max(int(round(self._pause * 1000)), MIN_FRAME_DURATION)
+
+    def _fit(self, img, width=None):
+        """
+        Scales an image down to width and to the memory of one frame
+        """
+        h, w = img.shape[:2]
+        scale = min(1.0, math.sqrt(self.frame_budget / float(img.nbytes)))
+        if width is not None:
+            scale = min(scale, width / float(w))
+        if scale >= 1.0:
+            return img.copy()
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    def update(self, image):
+        if self.is_full() or self.ended:
+            return
+        t = time.time()
+        if t - self._last > self._pause:
+            self._last = t
+            try:
+                self.queue.put_nowait(self._fit(image, self.width))
+            except Full:
+                self.dropped += 1
+                self.log.debug("encoder behind, dropped frame {:d}".format(len(self._images) + 1))
+                return
+            # playback copy, the display scales it up
+            self._images.append(self._fit(image))
+            if self.is_full():
+                self.finish()
+
+    def finish(self):
+        """
+        Ends the recording, the worker writes the GIFs once it encoded the queued frames
+        """
+        if not self.ended:
+            self.ended = True
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                # the worker sees the end once it emptied the queue
+                pass
+
+    def abort(self):
+        """
+        Ends the recording or its encoding and removes the partial GIFs
+        """
+        self.aborted = True
+        self.finish()
+
+    def join(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        palette = None
+        # frames waiting for the palette
+        pending = []
+        try:
+            while True:
+                try:
+                    frame = self.queue.get(timeout=STREAM_POLL_INTERVAL)
+                except Empty:
+                    if self.ended:
+                        break
+                    continue
+                if frame is None or self.aborted:
+                    break
+                pending.append(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+                del frame
+                if palette is None and len(pending) < self.palette_frames:
+                    continue
+                palette = self._encode(pending, palette)
+                pending = []
+            if len(pending) and not self.aborted:
+                # fewer frames than palette_frames were recorded
+                self._encode(pending, palette)
+        except Exception as e:
+            self.log.error("encoding GIF failed: {}".format(e))
+            self.error = e
+        if self.dropped:
+            self.log.warning("encoder fell behind, {:d} frames dropped while recording {}".format(
+                self.dropped, self.path))
+        for stream in (self._gif, self._thumb):
+            if stream is None:
+                continue
+            if self.aborted or self.error is not None:
+                stream.abort()
+            else:
+                stream.close()
+        if self._gif is not None and not self.aborted and self.error is None and self.callback is not None:
+            self.callback(self.thumb_path if self.thumb_path is not None else self.path)
+
+    def _encode(self, frames, palette=None):
+        """
+        Appends frames to the GIF and the thumbnail GIF, the first call creates both
+        :param frames: RGB images
+        :param palette: palette image, computed from the frames if None
+        :return: palette image
+        """
+        if palette is None:
+            palette = shared_palette(frames)
+            self._gif = GIFStream(self.path, self.duration)
+            if self.thumb_path is not None:
+                self._thumb = GIFStream(self.thumb_path, self.duration)
+        for rgb in frames:
+            self._gif.add(rgb.quantize(palette=palette, dither=Image.Dither.NONE))
+            if self._thumb is not None:
+                width, height = rgb.size
+                if self.thumb_width is not None and self.thumb_width < width:
+                    size = (self.thumb_width, int(round(height * self.thumb_width / float(width))))
+                    rgb = rgb.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+                self._thumb.add(rgb.quantize(palette=palette, dither=Image.Dither.NONE))
+        return palette
+
+    @property
+    def images(self):
+        return self._images
+
+    def is_full(self):
+        return len(self._images) >= self._size
+
+    def __len__(self):
+        return len(self._images)
@@ -0,0 +1,194 @@
+import hashlib
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+CHUNK_SIZE = 64 * 1024
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP_ENTRY_LIMIT = 0xFFFF
+# general purpose flag: file names are UTF-8
+FLAG_UTF8 = 0x0800
+# version 2.0: stored files, version 4.5: zip64 extensions
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+
+# CRC-32 of archived files, keyed by (path, size, mtime)
+_crc_cache = OrderedDict()
+_crc_cache_lock = Lock()
+CRC_CACHE_SIZE = 100000
+
+
+def file_crc(path, size, mtime):
+    key = (path, size, mtime)
+    with _crc_cache_lock:
+        crc = _crc_cache.get(key)
+    if crc is not None:
+        return crc
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    with _crc_cache_lock:
+        _crc_cache[key] = crc
+        while len(_crc_cache) > CRC_CACHE_SIZE:
+            _crc_cache.popitem(last=False)
+    return crc
+
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+           ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipEntry:
+
+    def __init__(self, arcname, path):
+        stat = os.stat(path)
+        if stat.st_size >= ZIP32_LIMIT:
+            raise ValueError("{} is too large for the archive".format(path))
+        self.arcname = arcname.encode("utf-8")
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.dos_time, self.dos_date = dos_datetime(stat.st_mtime)
+        self.offset = 0
+
+    @property
+    def crc(self):
+        return file_crc(self.path, self.size, self.mtime)
+
+    @property
+    def local_header_size(self):
+        return 30 + len(self.arcname)
+
+    def local_header(self):
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, VERSION_DEFAULT, FLAG_UTF8, 0,
+                           self.dos_time, self.dos_date, self.crc, self.size, self.size,
+                           len(self.arcname), 0) + self.arcname
+
+    @property
+    def zip64(self):
+        return self.offset >= ZIP32_LIMIT
+
+    @property
+    def central_header_size(self):
+        return 46 + len(self.arcname) + (12 if self.zip64 else 0)
+
+    def central_header(self):
+        extra = b""
+        offset = self.offset
+        version = VERSION_DEFAULT
+        if self.zip64:
+            extra = struct.pack("<HHQ", 0x0001, 8, self.offset)
+            offset = ZIP32_LIMIT
+            version = VERSION_ZIP64
+        return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | version, version, FLAG_UTF8, 0,
+                           self.dos_time, self.dos_date, self.crc, self.size, self.size,
+                           len(self.arcname), len(extra), 0, 0, 0, 0o100644 << 16,
+                           offset) + self.arcname + extra
+
+
+class ZipStream:
+    """
+    ZIP archive of stored (uncompressed) files that is generated while it is sent.
+
+    The layout only depends on file names, sizes and times, so the archive size
+    is known up front and any byte range can be generated without temporary
+    files. Memory usage is constant: files are read chunk by chunk, once for the
+    CRC-32 in the local header and once for the data.
+    """
+
+    def __init__(self, files):
+        """
+        :param files: list of (archive name, path)
+        """
+        self.entries = [ZipEntry(arcname, path) for arcname, path in files]
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += entry.local_header_size + entry.size
+        self.central_offset = offset
+        self.central_size = sum(entry.central_header_size for entry in self.entries)
+        self.size = self.central_offset + self.central_size + self.end_size
+
+    @property
+    def zip64(self):
+        return self.central_offset + self.central_size >= ZIP32_LIMIT or len(self.entries) >= ZIP_ENTRY_LIMIT
+
+    @property
+    def end_size(self):
+        return 22 + (56 + 20 if self.zip64 else 0)
+
+    @property
+    def etag(self):
+        h = hashlib.sha1()
+        for entry in self.entries:
+            h.update(entry.arcname)
+            h.update(struct.pack("<QQ", entry.size, entry.mtime))
+        return h.hexdigest()
+
+    def end_records(self):
+        count = len(self.entries)
+        records = b""
+        if self.zip64:
+            end64_offset = self.central_offset + self.central_size
+            records += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | VERSION_ZIP64, VERSION_ZIP64,
+                                   0, 0, count, count, self.central_size, self.central_offset)
+            records += struct.pack("<IIQI", 0x07064b50, 0, end64_offset, 1)
+        return records + struct.pack("<IHHHHIIH", 0x06054b50, 0, 0,
+                                     min(count, ZIP_ENTRY_LIMIT), min(count, ZIP_ENTRY_LIMIT),
+                                     min(self.central_size, ZIP32_LIMIT),
+                                     min(self.central_offset, ZIP32_LIMIT), 0)
+
+    def _segments(self):
+        """
+        Yields (length, function returning an iterator over the bytes in [start, stop) of the segment)
+        """
+        def data(b):
+            return lambda start, stop: iter((b()[start:stop],))
+
+        def file_data(path):
+            def read(start, stop):
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    left = stop - start
+                    while left > 0:
+                        chunk = f.read(min(CHUNK_SIZE, left))
+                        if not chunk:
+                            raise IOError("{} changed while archiving".format(path))
+                        left -= len(chunk)
+                        yield chunk
+            return read
+
+        for entry in self.entries:
+            yield entry.local_header_size, data(entry.local_header)
+            yield entry.size, file_data(entry.path)
+        for entry in self.entries:
+            yield entry.central_header_size, data(entry.central_header)
+        yield self.end_size, data(self.end_records)
+
+    def iter_bytes(self, start=0, stop=None):
+        """
+        Generates the archive or a byte range of it
+        :param start: first byte
+        :param stop: end of the range (exclusive) or None for the end of the archive
+        :return: generator of bytes
+        """
+        if stop is None:
+            stop = self.size
+        position = 0
+        for length, read in self._segments():
+            if position >= stop:
+                break
+            end = position + length
+            if end > start and length:
+                for chunk in read(max(start - position, 0), min(stop, end) - position):
+                    yield chunk
+            position = end
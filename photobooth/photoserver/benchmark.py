@@ -0,0 +1,323 @@
+"""
+Load test of the photoserver against a synthetic gallery.
+
+Simulates phones that poll for new images, scroll through the gallery page by
+page (listing, HTML page and thumbnails) and watch the slideshow. The app is
+driven either in-process through the Flask test client or over HTTP through
+the gevent server started by photoserver.server.serve().
+
+    python -m photobooth.photoserver.benchmark --sizes 1000 10000 50000 --output bench.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+from threading import Thread, Lock
+import cv2
+import numpy as np
+from PIL import Image
+
+MODES = ("inprocess", "gevent")
+
+
+def make_gallery(path, count, gif_ratio=0.1, width=1280, seed=0):
+    """
+    Creates a synthetic image directory. All images are hard links to one JPEG
+    and one GIF, so even 50k images need almost no disk space.
+    :param path: image directory
+    :param count: number of images
+    :param gif_ratio: fraction of GIFs
+    :param width: image width
+    :param seed: random seed
+    :return: list of image names, oldest first
+    """
+    rng = np.random.RandomState(seed)
+    height = width * 2 // 3
+    # smooth noise compresses like a photo, not like a flat color
+    img = cv2.resize(rng.randint(0, 255, (height // 16, width // 16, 3)).astype(np.uint8), (width, height))
+    jpeg = os.path.join(path, "source.jpg")
+    cv2.imwrite(jpeg, img)
+    gif = os.path.join(path, "source.gif")
+    frames = [Image.fromarray(cv2.cvtColor(np.roll(img, i * 40, axis=1)[::4, ::4], cv2.COLOR_BGR2RGB))
+              for i in range(5)]
+    frames[0].save(gif, save_all=True, append_images=frames[1:], duration=200, loop=0)
+
+    names = []
+    t0 = datetime.datetime(2019, 6, 1, 12, 0, 0)
+    for directory in ("images", "thumbs"):
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    for i in range(count):
+        ext = "gif" if rng.rand() < gif_ratio else "jpg"
+        name = "{}.{}".format((t0 + datetime.timedelta(seconds=7 * i)).strftime("%Y-%m-%d_%H-%M-%S"), ext)
+        source = gif if ext == "gif" else jpeg
+        for directory in ("images", "thumbs"):
+            target = os.path.join(path, directory, name)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+        names.append(name)
+    return names
+
+
+class InProcessTransport:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, path, headers):
+        response = self.client.get(path, headers=headers)
+        body = response.get_data()
+        return response.status_code, response.headers, body
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+
+    def __init__(self, host, port):
+        self.conn = http.client.HTTPConnection(host, port, timeout=30)
+
+    def request(self, path, headers):
+        self.conn.request("GET", path, headers=headers)
+        response = self.conn.getresponse()
+        body = response.read()
+        return response.status, response.headers, body
+
+    def close(self):
+        self.conn.close()
+
+
+class Phone:
+    """
+    One simulated client. Every step polls the latest image, loads the next
+    gallery page with its thumbnails and sometimes looks at the slideshow.
+    """
+
+    def __init__(self, names, thumb_path="/thumb/{}", seed=0):
+        self.names = names
+        self.thumb_path = thumb_path
+        self.rng = random.Random(seed)
+        self.etags = {}
+        self.bodies = {}
+        self.cursor = None
+        self.step = 0
+
+    def requests(self):
+        """
+        Yields (kind, path) and receives the response body of listings
+        """
+        while True:
+            yield "latest", "/api/v1/latest_filename"
+            path = "/api/v1/images?limit=10"
+            if self.cursor is not None:
+                path += "&after=" + self.cursor
+            body = yield "images", path
+            page = json.loads(body) if body else dict(images=[], next=None)
+            yield "index", "/" if self.cursor is None else "/?after=" + self.cursor
+            for name in page["images"]:
+                yield "thumb", self.thumb_path.format(name)
+            self.cursor = page["next"]
+            if self.step % 5 == 0:
+                yield "slideshow", "/slideshow"
+                yield "slide", "/thumb/1280/" + self.rng.choice(self.names)
+            self.step += 1
+
+    def headers(self, path):
+        etag = self.etags.get(path)
+        return {"If-None-Match": etag} if etag else {}
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = {}
+        self.bytes = {}
+        self.errors = {}
+
+    def add(self, kind, latency, size, error=False):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            self.bytes[kind] = self.bytes.get(kind, 0) + size
+            if error:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    @staticmethod
+    def percentile(values, p):
+        if not len(values):
+            return None
+        values = sorted(values)
+        return values[min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)]
+
+    def report(self, duration):
+        report = {}
+        kinds = sorted(self.latencies.keys())
+        all_latencies = []
+        for kind in kinds + ["total"]:
+            if kind == "total":
+                latencies = all_latencies
+                size = sum(self.bytes.values())
+                errors = sum(self.errors.values())
+            else:
+                latencies = self.latencies[kind]
+                all_latencies.extend(latencies)
+                size = self.bytes[kind]
+                errors = self.errors.get(kind, 0)
+            count = len(latencies)
+            report[kind] = dict(requests=count,
+                                errors=errors,
+                                rps=count / duration,
+                                p50_ms=self.percentile(latencies, 50) * 1000 if count else None,
+                                p99_ms=self.percentile(latencies, 99) * 1000 if count else None,
+                                max_ms=max(latencies) * 1000 if count else None,
+                                bytes_per_request=size / float(count) if count else None)
+        return report
+
+
+def run_phone(transport, phone, stats, deadline):
+    requests = phone.requests()
+    kind, path = next(requests)
+    try:
+        while time.time() < deadline:
+            t = time.perf_counter()
+            try:
+                status, headers, body = transport.request(path, phone.headers(path))
+                error = status >= 400
+            except (OSError, http.client.HTTPException):
+                status, headers, body, error = 0, {}, b"", True
+            stats.add(kind, time.perf_counter() - t, len(body), error)
+            if status == 304 and kind == "images":
+                body = phone.bodies.get(path)
+            elif headers.get("ETag") and kind in ("latest", "images"):
+                # revalidate listings like a browser cache
+                phone.etags[path] = headers.get("ETag")
+                phone.bodies[path] = body
+            kind, path = requests.send(body if kind == "images" else None)
+    finally:
+        transport.close()
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def benchmark(image_dir, names, mode, clients=10, duration=10.0, workers=1, port=5099, thumb_path="/thumb/{}"):
+    """
+    Runs simulated phones against the photoserver
+    :return: report dict
+    """
+    server = None
+    if mode == "gevent":
+        from photobooth.photoserver.server import serve
+        server = multiprocessing.Process(target=serve, args=(image_dir,),
+                                         kwargs=dict(host="127.0.0.1", port=port, workers=workers),
+                                         daemon=True)
+        server.start()
+        if not wait_for_port("127.0.0.1", port):
+            server.terminate()
+            raise RuntimeError("photoserver did not start")
+
+        def transport():
+            return HTTPTransport("127.0.0.1", port)
+    else:
+        from photobooth.photoserver import app
+        app.config["IMAGE_DIR"] = image_dir
+
+        def transport():
+            return InProcessTransport(app)
+
+    # warm up the gallery index
+    t = transport()
+    t.request("/api/v1/latest_filename", {})
+    t.close()
+
+    stats = Stats()
+    deadline = time.time() + duration
+    threads = [Thread(target=run_phone, args=(transport(), Phone(names, thumb_path, seed=i), stats, deadline))
+               for i in range(clients)]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t0
+    if server is not None:
+        server.terminate()
+        server.join()
+    return stats.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Photoserver load test against a synthetic gallery')
+    parser.add_argument('--sizes', type=int, nargs='+', help='gallery sizes', default=[1000, 10000, 50000])
+    parser.add_argument('--modes', type=str, nargs='+', choices=MODES, help='how to drive the app', default=list(MODES))
+    parser.add_argument('--clients', type=int, help='simulated phones', default=10)
+    parser.add_argument('--duration', type=float, help='duration per run in seconds', default=10.0)
+    parser.add_argument('--workers', type=int, help='server worker processes (gevent mode)', default=1)
+    parser.add_argument('--port', type=int, help='server port (gevent mode)', default=5099)
+    parser.add_argument('--thumb-width', type=int, help='request resized thumbnails of this width', default=None)
+    parser.add_argument('--image-dir', type=str, help='directory for the synthetic galleries', default=None)
+    parser.add_argument('--output', type=str, help='write JSON results to file', default=None)
+    args = parser.parse_args()
+
+    thumb_path = "/thumb/{}" if args.thumb_width is None else "/thumb/{:d}/{{}}".format(args.thumb_width)
+    results = dict(created=datetime.datetime.now().isoformat(),
+                   clients=args.clients,
+                   duration=args.duration,
+                   workers=args.workers,
+                   thumb_path=thumb_path,
+                   runs=[])
+    base_dir = args.image_dir or tempfile.mkdtemp(prefix="photoserver-bench-")
+    try:
+        for size in args.sizes:
+            image_dir = os.path.join(base_dir, "gallery-{:d}".format(size))
+            if not os.path.exists(image_dir):
+                os.makedirs(image_dir)
+                names = make_gallery(image_dir, size)
+            else:
+                names = sorted(n for n in os.listdir(os.path.join(image_dir, "thumbs")) if not n.startswith("."))
+            for mode in args.modes:
+                report = benchmark(image_dir, names, mode,
+                                   clients=args.clients,
+                                   duration=args.duration,
+                                   workers=args.workers,
+                                   port=args.port,
+                                   thumb_path=thumb_path)
+                results["runs"].append(dict(size=size, mode=mode, report=report))
+                total = report["total"]
+                print("{:>6d} images {:>9s}: {:8.1f} req/s  p50 {:7.2f} ms  p99 {:7.2f} ms  {:9.0f} B/req".format(
+                    size, mode, total["rps"], total["p50_ms"] or 0, total["p99_ms"] or 0,
+                    total["bytes_per_request"] or 0))
+                for kind, r in sorted(report.items()):
+                    if kind == "total":
+                        continue
+                    print("    {:>10s}: {:6d} req  p50 {:7.2f} ms  p99 {:7.2f} ms  {:9.0f} B/req  {:d} errors".format(
+                        kind, r["requests"], r["p50_ms"] or 0, r["p99_ms"] or 0, r["bytes_per_request"] or 0,
+                        r["errors"]))
+    finally:
+        if args.image_dir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
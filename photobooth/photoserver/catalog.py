@@ -0,0 +1,298 @@
+import datetime
+import logging
+import os
+import sqlite3
+import uuid
+from threading import Lock
+from PIL import Image
+
+CATALOG_NAME = "catalog.sqlite"
+IMAGE_TYPES = (".gif", ".jpg", ".jpeg")
+VARIANT_TYPES = ("avif", "webp", "mp4", "webm")
+NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    captured_at REAL,
+    width INTEGER,
+    height INTEGER,
+    size INTEGER,
+    thumb_width INTEGER,
+    thumb_height INTEGER,
+    thumb_size INTEGER,
+    variants TEXT NOT NULL DEFAULT '',
+    mtime_ns INTEGER,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_captured_at ON photos (captured_at);
+CREATE INDEX IF NOT EXISTS photos_seq ON photos (seq);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+COLUMNS = ("name", "kind", "captured_at", "width", "height", "size",
+           "thumb_width", "thumb_height", "thumb_size", "variants", "mtime_ns")
+
+
+def is_image(name):
+    return not name.startswith(".") and name.lower().endswith(IMAGE_TYPES)
+
+
+def _dimensions(path):
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except (IOError, SyntaxError):
+        return None, None
+
+
+def probe(image_dir, name, thumb_stat=None):
+    """
+    Collects the catalog record of an image from the files in the image directory
+    :param image_dir: photobooth image directory
+    :param name: image name
+    :param thumb_stat: os.stat_result of the thumbnail if already known
+    :return: dict with the catalog columns
+    """
+    thumb = os.path.join(image_dir, "thumbs", name)
+    image = os.path.join(image_dir, "images", name)
+    if thumb_stat is None:
+        thumb_stat = os.stat(thumb)
+    try:
+        # the time part of e.g. <time>-2.jpg or <time>_strip.jpg
+        captured_at = datetime.datetime.strptime(os.path.splitext(name)[0][:19], NAME_FORMAT).timestamp()
+    except ValueError:
+        captured_at = thumb_stat.st_mtime
+    width = height = size = None
+    if os.path.exists(image):
+        width, height = _dimensions(image)
+        size = os.path.getsize(image)
+    thumb_width, thumb_height = _dimensions(thumb)
+    variants = [ext for ext in VARIANT_TYPES if os.path.exists("{}.{}".format(thumb, ext))]
+    return dict(name=name,
+                kind="gif" if name.lower().endswith(".gif") else "photo",
+                captured_at=captured_at,
+                width=width,
+                height=height,
+                size=size,
+                thumb_width=thumb_width,
+                thumb_height=thumb_height,
+                thumb_size=thumb_stat.st_size,
+                variants=",".join(variants),
+                mtime_ns=thumb_stat.st_mtime_ns)
+
+
+class Catalog:
+    """
+    Persistent SQLite catalog of the published images in <image_dir>/catalog.sqlite.
+
+    The capture pipeline writes a record on every publish. Every insert or
+    delete increments a generation counter stored in the catalog, which all
+    server processes share. reconcile() brings the catalog up to date with
+    files written without it, and skips the directory scan entirely while the
+    thumbs directory mtime matches the one recorded at the last change.
+    """
+
+    def __init__(self, image_dir):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, CATALOG_NAME)
+        self._lock = Lock()
+        self._conn = None
+        self._pid = None
+        # connect now to fail early if the image directory is not writable
+        self._connection()
+
+    def _connection(self):
+        # connections must not be shared with forked server processes
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('instance', ?)", (uuid.uuid4().hex[:8],))
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._connection().execute(sql, args).fetchall()
+
+    def _meta(self, conn, key):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _thumbs_mtime(self):
+        try:
+            return os.stat(os.path.join(self.image_dir, "thumbs")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @property
+    def instance(self):
+        """
+        Random id of the catalog, keeps entity tags unique if the catalog is recreated
+        """
+        return self._query("SELECT value FROM meta WHERE key = 'instance'")[0][0]
+
+    def generation(self):
+        return self._query("SELECT value FROM meta WHERE key = 'generation'")[0][0]
+
+    def _upsert(self, conn, record):
+        """
+        Inserts or updates a record, only inserts increment the generation
+        :return: True if the record was inserted
+        """
+        exists = conn.execute("SELECT 1 FROM photos WHERE name = ?", (record["name"],)).fetchone()
+        values = [record.get(column) for column in COLUMNS]
+        if exists:
+            conn.execute("UPDATE photos SET {} WHERE name = ?".format(
+                ", ".join("{} = ?".format(column) for column in COLUMNS[1:])), values[1:] + values[:1])
+            return False
+        generation = self._meta(conn, "generation") + 1
+        self._set_meta(conn, "generation", generation)
+        conn.execute("INSERT INTO photos ({}, seq) VALUES ({}, ?)".format(
+            ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), values + [generation])
+        return True
+
+    def publish(self, name):
+        """
+        Records a published image
+        :param name: image name in the thumbs directory
+        :return: True if the image was not in the catalog yet
+        """
+        record = probe(self.image_dir, name)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                inserted = self._upsert(conn, record)
+                # the directory changed because of this image, no reconciliation needed
+                self._set_meta(conn, "thumbs_mtime", self._thumbs_mtime())
+        return inserted
+
+    def add_variants(self, name, variants):
+        """
+        Records encoded variants (file extensions) of an image
+        """
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT variants FROM photos WHERE name = ?", (name,)).fetchone()
+                if row is not None:
+                    known = set(v for v in row[0].split(",") if v)
+                    conn.execute("UPDATE photos SET variants = ? WHERE name = ?",
+                                 (",".join(sorted(known | set(variants))), name))
+                # variants are stored in the thumbs directory
+                self._set_meta(conn, "thumbs_mtime", self._thumbs_mtime())
+
+    def reconcile(self):
+        """
+        Updates the catalog with changes of the thumbs directory made without it.
+        Only thumbnails whose mtime changed are probed.
+        :return: number of inserted, updated and removed records
+        """
+        mtime = self._thumbs_mtime()
+        with self._lock:
+            conn = self._connection()
+            if self._meta(conn, "thumbs_mtime") == mtime:
+                return 0
+            known = dict(conn.execute("SELECT name, mtime_ns FROM photos").fetchall())
+        thumbs = os.path.join(self.image_dir, "thumbs")
+        found = {}
+        if mtime is not None:
+            for entry in os.scandir(thumbs):
+                if is_image(entry.name):
+                    found[entry.name] = entry.stat()
+        records = [probe(self.image_dir, name, stat) for name, stat in found.items()
+                   if known.get(name) != stat.st_mtime_ns]
+        removed = [name for name in known if name not in found]
+
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for record in records:
+                    self._upsert(conn, record)
+                if len(removed):
+                    conn.executemany("DELETE FROM photos WHERE name = ?", [(name,) for name in removed])
+                    self._set_meta(conn, "generation", self._meta(conn, "generation") + len(removed))
+                self._set_meta(conn, "thumbs_mtime", mtime)
+        if len(records) or len(removed):
+            self.log.info("reconciled {}: {:d} changed, {:d} removed".format(thumbs, len(records), len(removed)))
+        return len(records) + len(removed)
+
+    def names(self):
+        """
+        Returns all image names in ascending order and the matching generation
+        """
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                generation = self._meta(conn, "generation")
+                names = [row[0] for row in conn.execute("SELECT name FROM photos ORDER BY name")]
+        return generation, names
+
+    def changes_since(self, generation):
+        """
+        Returns the images inserted after a generation
+        :return: current generation, number of images and list of (generation, name) ordered by generation
+        """
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN")
+                current = self._meta(conn, "generation")
+                count = conn.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+                changes = conn.execute("SELECT seq, name FROM photos WHERE seq > ? ORDER BY seq",
+                                       (generation,)).fetchall()
+        return current, count, changes
+
+    def _where(self, first=None, last=None, kind=None):
+        clauses, args = [], []
+        if first:
+            clauses.append("name >= ?")
+            args.append(first)
+        if last:
+            clauses.append("name <= ?")
+            args.append(last + "\uffff")
+        if kind:
+            clauses.append("kind = ?")
+            args.append(kind)
+        return (" WHERE " + " AND ".join(clauses)) if len(clauses) else "", args
+
+    def count(self, first=None, last=None, kind=None):
+        """
+        Counts images between two names or prefixes
+        """
+        where, args = self._where(first, last, kind)
+        return self._query("SELECT COUNT(*) FROM photos" + where, args)[0][0]
+
+    def summary(self, first=None, last=None):
+        """
+        Returns count and byte size per kind of the images between two names or prefixes
+        """
+        where, args = self._where(first, last)
+        rows = self._query("SELECT kind, COUNT(*), SUM(size), SUM(thumb_size), MIN(name), MAX(name) "
+                           "FROM photos{} GROUP BY kind".format(where), args)
+        return {kind: dict(count=count, size=size or 0, thumb_size=thumb_size or 0, first=first_name, last=last_name)
+                for kind, count, size, thumb_size, first_name, last_name in rows}
+
+    def get(self, name):
+        rows = self._query("SELECT {} FROM photos WHERE name = ?".format(", ".join(COLUMNS)), (name,))
+        if not len(rows):
+            return None
+        record = dict(zip(COLUMNS, rows[0]))
+        record["variants"] = [v for v in record["variants"].split(",") if v]
+        return record
@@ -0,0 +1,84 @@
+import json
+import time
+# cooperative under the gevent WSGIServer, a plain sleep in any other thread
+from gevent import sleep
+
+# interval for checking the in-memory gallery generation
+POLL_INTERVAL = 0.25
+# interval for checking the thumbs directory for files written by other processes
+REFRESH_INTERVAL = 1.0
+# comment sent to keep idle event streams open through proxies
+KEEPALIVE_INTERVAL = 15.0
+
+
+def wait_for_change(gallery, generation, timeout):
+    """
+    Waits until the gallery changes or the timeout is reached
+    :param gallery: Gallery
+    :param generation: generation known by the client
+    :param timeout: timeout in seconds
+    :return: True if the gallery changed
+    """
+    deadline = time.monotonic() + timeout
+    next_refresh = 0
+    while True:
+        now = time.monotonic()
+        if now >= next_refresh:
+            gallery.refresh()
+            next_refresh = now + REFRESH_INTERVAL
+        if gallery.generation != generation:
+            return True
+        if now >= deadline:
+            return False
+        sleep(min(POLL_INTERVAL, deadline - now))
+
+
+def poll(gallery, generation, timeout):
+    """
+    Long-poll variant of the event stream
+    :param gallery: Gallery
+    :param generation: generation known by the client or None to get the current generation
+    :param timeout: maximum time to wait for new images in seconds
+    :return: dict with the new generation, the new images and a reset flag
+    """
+    if generation is None:
+        current, images = gallery.generation, None
+    else:
+        wait_for_change(gallery, generation, timeout)
+        current, images = gallery.changes_since(generation)
+    return dict(generation=current, images=images or [], latest=gallery.latest(), reset=images is None)
+
+
+def _event(name, data, event_id=None):
+    msg = ""
+    if event_id is not None:
+        msg += "id: {}\n".format(event_id)
+    msg += "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
+    return msg
+
+
+def stream(gallery, generation, lifetime=600):
+    """
+    Server-sent event stream of new images. The stream ends after its lifetime,
+    the browser reconnects and resumes with the Last-Event-ID header.
+    :param gallery: Gallery
+    :param generation: generation known by the client or None
+    :param lifetime: maximum lifetime of the stream in seconds
+    :return: generator of event stream messages
+    """
+    yield "retry: 3000\n\n"
+    end = time.monotonic() + lifetime
+    if generation is None:
+        generation = gallery.generation
+        yield _event("hello", dict(generation=generation, latest=gallery.latest()), generation)
+    while time.monotonic() < end:
+        if not wait_for_change(gallery, generation, KEEPALIVE_INTERVAL):
+            yield ": keepalive\n\n"
+            continue
+        current, images = gallery.changes_since(generation)
+        if images is None:
+            yield _event("reset", dict(generation=current, latest=gallery.latest()), current)
+        else:
+            for name in images:
+                yield _event("image", dict(name=name, generation=current), current)
+        generation = current
@@ -0,0 +1,267 @@
+import bisect
+import logging
+import os
+import sqlite3
+import uuid
+from collections import deque
+from threading import Lock
+from .catalog import Catalog, is_image
+
+log = logging.getLogger("Gallery")
+
+
+class Gallery:
+    """
+    Sorted in-memory index of the published thumbnails in <image_dir>/thumbs.
+
+    The index is loaded once from the SQLite catalog of the image directory and
+    then updated incrementally: add() records a published image in the catalog,
+    refresh() fetches the images other processes inserted since the last known
+    catalog generation. Changes of the thumbs directory made without the
+    catalog are reconciled when its mtime changes. Without a catalog (e.g. a
+    read-only image directory) the index falls back to scanning the directory.
+    """
+
+    def __init__(self, image_dir, catalog=True):
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, "thumbs")
+        # image names in ascending order, the newest image is the last one
+        self._names = []
+        self._mtime = None
+        self._lock = Lock()
+        # generation of the catalog (or a counter without catalog) the index is up to date with
+        self.generation = 0
+        # (generation, name) of the latest changes, name is None if images were removed
+        self._events = deque(maxlen=256)
+        # changes_since() can answer for generations >= _log_start
+        self._log_start = 0
+        self.catalog = None
+        if catalog:
+            try:
+                self.catalog = Catalog(image_dir)
+            except sqlite3.Error as e:
+                log.warning("no catalog for {}: {}".format(image_dir, e))
+        # generations without catalog restart with every process, the instance keeps entity tags unique
+        self._instance = self.catalog.instance if self.catalog is not None else uuid.uuid4().hex[:8]
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """
+        Brings the index up to date with the catalog or the thumbs directory
+        :return: self
+        """
+        mtime = self._dir_mtime()
+        if self.catalog is None:
+            if mtime != self._mtime:
+                self._rescan(mtime)
+            return self
+        if mtime != self._mtime:
+            self.catalog.reconcile()
+            self._mtime = mtime
+        if self.catalog.generation() != self.generation:
+            self._sync()
+        return self
+
+    def _rescan(self, mtime):
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            names = []
+            if mtime is not None:
+                names = sorted(name for name in os.listdir(self.path) if is_image(name))
+            if names != self._names:
+                known = set(self._names)
+                added = [name for name in names if name not in known]
+                if len(known) + len(added) != len(names):
+                    self._log(None)
+                for name in added:
+                    self._log(name)
+                self._names = names
+            self._mtime = mtime
+
+    def _sync(self):
+        """
+        Fetches the images inserted into the catalog since the generation of the index
+        """
+        with self._lock:
+            current, count, changes = self.catalog.changes_since(self.generation)
+            if current == self.generation:
+                return
+            new = [(generation, name) for generation, name in changes if not self._contains(name)]
+            if current < self.generation or len(self._names) + len(new) != count \
+                    or len(new) > self._events.maxlen:
+                # images were removed, the catalog was recreated or this is the first load
+                current, self._names = self.catalog.names()
+                self._log(None, current)
+                return
+            for generation, name in new:
+                bisect.insort(self._names, name)
+                self._log(name, generation)
+            self.generation = current
+
+    def _contains(self, name):
+        i = bisect.bisect_left(self._names, name)
+        return i < len(self._names) and self._names[i] == name
+
+    def add(self, name):
+        """
+        Adds a published image to the index
+        :param name: file name in the thumbs directory
+        :return: True if the image was not indexed yet
+        """
+        if not is_image(name):
+            return False
+        if self.catalog is not None:
+            inserted = self.catalog.publish(name)
+            self._sync()
+            # the directory changed because of this image, no reconciliation needed
+            self._mtime = self._dir_mtime()
+            return inserted
+        with self._lock:
+            if self._contains(name):
+                return False
+            # new captures are the newest images, so this is an append in practice
+            bisect.insort(self._names, name)
+            self._log(name)
+            # the directory changed because of this image, no rescan needed
+            self._mtime = self._dir_mtime()
+        return True
+
+    @property
+    def etag(self):
+        """
+        Entity tag of the current state of the index
+        """
+        return "{}-{:d}".format(self._instance, self.generation)
+
+    def _log(self, name, generation=None):
+        if generation is None:
+            generation = self.generation + 1
+        if name is None:
+            # clients that missed this change have to reload
+            self._events.clear()
+            self._log_start = generation
+        elif len(self._events) == self._events.maxlen:
+            self._log_start = self._events[0][0]
+        self.generation = generation
+        self._events.append((generation, name))
+
+    def changes_since(self, generation):
+        """
+        Returns the images added after a generation of the index
+        :param generation: generation known by the client
+        :return: current generation and list of image names (oldest first),
+                 the list is None if the client has to reload the whole gallery
+        """
+        with self._lock:
+            current = self.generation
+            if generation > current:
+                return current, None
+            if generation == current:
+                return current, []
+            if generation < self._log_start:
+                return current, None
+            names = [name for g, name in self._events if g > generation]
+        if None in names:
+            return current, None
+        return current, names
+
+    def latest(self):
+        names = self._names
+        return names[-1] if len(names) else None
+
+    def page(self, start, count):
+        """
+        Returns images ordered from newest to oldest
+        :param start: number of newest images to skip
+        :param count: maximum number of images
+        :return: list of image names
+        """
+        names = self._names
+        stop = max(len(names) - start, 0)
+        return names[max(stop - count, 0):stop][::-1]
+
+    def after(self, name, count):
+        """
+        Returns images older than a cursor, ordered from newest to oldest
+        :param name: cursor image name, does not need to exist
+        :param count: maximum number of images
+        :return: list of image names
+        """
+        names = self._names
+        stop = bisect.bisect_left(names, name)
+        return names[max(stop - count, 0):stop][::-1]
+
+    def before(self, name, count):
+        """
+        Returns the images newer than a cursor that are closest to it, ordered from newest to oldest
+        :param name: cursor image name, does not need to exist
+        :param count: maximum number of images
+        :return: list of image names
+        """
+        names = self._names
+        start = bisect.bisect_right(names, name)
+        return names[start:start + count][::-1]
+
+    def range(self, first=None, last=None):
+        """
+        Returns the images between two names, e.g. timestamp prefixes
+        :param first: first image name or prefix or None for the oldest image
+        :param last: last image name or prefix (inclusive) or None for the newest image
+        :return: list of image names ordered from oldest to newest
+        """
+        names = self._names
+        start = bisect.bisect_left(names, first) if first else 0
+        stop = bisect.bisect_right(names, last + "\uffff") if last else len(names)
+        return names[start:stop]
+
+    def cursor_page(self, after=None, before=None, limit=10):
+        """
+        Returns a page of images relative to a cursor. Pages stay stable while
+        new images are added because cursors are image names, not offsets.
+        :param after: return the images following this image
+        :param before: return the images preceding this image
+        :param limit: page size
+        :return: images (newest first), cursor of the previous page, cursor of the next page
+        """
+        if before is not None:
+            images = self.before(before, limit)
+        elif after is not None:
+            images = self.after(after, limit)
+        else:
+            images = self.page(0, limit)
+        if not len(images):
+            return images, None, None
+        prev_cursor = images[0] if len(self.before(images[0], 1)) else None
+        next_cursor = images[-1] if len(self.after(images[-1], 1)) else None
+        return images, prev_cursor, next_cursor
+
+    @property
+    def names(self):
+        return self._names[::-1]
+
+    def __len__(self):
+        return len(self._names)
+
+
+_galleries = {}
+_galleries_lock = Lock()
+
+
+def get_gallery(image_dir):
+    """
+    Returns the shared gallery index of an image directory
+    :param image_dir: photobooth image directory
+    :return: Gallery
+    """
+    key = os.path.abspath(image_dir)
+    with _galleries_lock:
+        gallery = _galleries.get(key)
+        if gallery is None:
+            gallery = _galleries[key] = Gallery(key)
+    return gallery
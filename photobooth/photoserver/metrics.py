@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import deque
+
+# the photobooth writes its metrics here, the photoserver processes read them
+METRICS_NAME = ".metrics.json"
+# memory backed directory for the snapshots, so the SD card is not written every second
+METRICS_TMPFS = "/dev/shm"
+# seconds between snapshots written to the image directory if there is no tmpfs
+DISK_DUMP_INTERVAL = 60
+# samples per stage the percentiles are computed from
+WINDOW = 512
+
+
+class RollingHistogram:
+    """
+    Durations of the last <window> samples of a stage. Recording is a deque
+    append, percentiles are only computed when a summary is requested.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not len(samples):
+            return dict(count=self.count, total_s=self.total, p50_ms=None, p95_ms=None, max_ms=None, mean_ms=None)
+        return dict(count=self.count,
+                    total_s=self.total,
+                    p50_ms=samples[len(samples) // 2] * 1000,
+                    p95_ms=samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000,
+                    max_ms=samples[-1] * 1000,
+                    mean_ms=sum(samples) / len(samples) * 1000)
+
+
+class Metrics:
+    """
+    Per-stage timings and gauges of the photobooth. Stages may be recorded from any thread.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.stages = {}
+        self.gauges = {}
+        self._t = None
+        # time of the last dump()
+        self._dumped = 0
+
+    def record(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages.setdefault(stage, RollingHistogram(self.window))
+        histogram.add(seconds)
+
+    def begin(self):
+        """
+        Starts timing the stages of a frame
+        """
+        self._t = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        Records the time since begin() or the last lap as a stage
+        """
+        t = time.perf_counter()
+        self.record(stage, t - self._t)
+        self._t = t
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return dict(time=time.time(),
+                    stages={stage: histogram.summary() for stage, histogram in list(self.stages.items())},
+                    gauges=dict(self.gauges))
+
+    def dump(self, image_dir):
+        """
+        Writes a snapshot for the photoserver atomically to metrics_path(). Without
+        a tmpfs, snapshots are written at most every DISK_DUMP_INTERVAL seconds.
+        """
+        path = metrics_path(image_dir)
+        now = time.time()
+        if not path.startswith(METRICS_TMPFS) and now - self._dumped < DISK_DUMP_INTERVAL:
+            return
+        self._dumped = now
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".metrics.", suffix=".tmp")
+        try:
+            os.chmod(tmp_path, 0o644)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def metrics_path(image_dir):
+    """
+    :return: path of the snapshot of the photobooth using image_dir, on the tmpfs if there is one
+    """
+    if not os.path.isdir(METRICS_TMPFS):
+        return os.path.join(image_dir, METRICS_NAME)
+    # one file per image directory, several photobooths may run on one machine
+    key = hashlib.sha1(os.path.abspath(os.path.expanduser(image_dir)).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(METRICS_TMPFS, "photobooth-{}{}".format(key, METRICS_NAME))
+
+
+def read_metrics(image_dir):
+    """
+    Reads the last snapshot of the photobooth
+    :return: snapshot dict with its age in seconds or None
+    """
+    try:
+        with open(metrics_path(image_dir)) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    snapshot["age"] = time.time() - snapshot["time"]
+    return snapshot
+
+
+def prometheus(snapshot, prefix="photobooth"):
+    """
+    Formats a snapshot in the Prometheus text exposition format
+    """
+    lines = ["# TYPE {}_stage_seconds summary".format(prefix)]
+    for stage, summary in sorted(snapshot["stages"].items()):
+        for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("1", "max_ms")):
+            if summary[key] is not None:
+                lines.append('{}_stage_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(
+                    prefix, stage, quantile, summary[key] / 1000.0))
+        lines.append('{}_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(prefix, stage, summary["total_s"]))
+        lines.append('{}_stage_seconds_count{{stage="{}"}} {:d}'.format(prefix, stage, summary["count"]))
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append("# TYPE {}_{} gauge".format(prefix, name))
+        lines.append("{}_{} {}".format(prefix, name, value))
+    lines.append("# TYPE {}_metrics_age_seconds gauge".format(prefix))
+    lines.append("{}_metrics_age_seconds {:.3f}".format(prefix, snapshot["age"]))
+    return "\n".join(lines) + "\n"
@@ -1,40 +1,142 @@
-from flask import render_template, send_from_directory, request, redirect, url_for, jsonify
+from flask import render_template, send_from_directory, request, redirect, url_for, jsonify, Response, abort
 from . import app
+from . import events
+from . import variants
+from .archive import ZipStream
 from .pagination import Pagination
+from .gallery import get_gallery
+from .metrics import read_metrics, prometheus
+from .tracing import read_traces, summarize
+from .thumbnails import get_thumbnail_cache, THUMB_WIDTHS, THUMB_CACHE_SIZE
+from werkzeug.security import safe_join
 import os
-import glob
+import time
 
 
 def url_for_other_page(page):
-    args = request.view_args.copy()
+    args = dict(request.view_args or {})
     args['page'] = page
-    return url_for(request.endpoint, **args)
+    return url_for('index', **args)
 
 
 app.jinja_env.globals['url_for_other_page'] = url_for_other_page
 
 
-@app.route('/', defaults={'page': 1})
+def thumb_widths():
+    return tuple(app.config.get("THUMB_WIDTHS", THUMB_WIDTHS))
+
+
+app.jinja_env.globals['thumb_widths'] = thumb_widths
+
+
+def thumb_srcset(name):
+    return ", ".join("/thumb/{0:d}/{1} {0:d}w".format(width, name) for width in thumb_widths())
+
+
+app.jinja_env.globals['thumb_srcset'] = thumb_srcset
+
+
+def video_sources(name):
+    """
+    Video variants of a GIF for a <video> element, smallest format first
+    :return: list of (url, mime type)
+    """
+    if not name.lower().endswith(".gif"):
+        return []
+    thumb = os.path.join(app.config.get("IMAGE_DIR", "."), "thumbs", name)
+    return [("/thumb/" + os.path.basename(variants.variant_path(name, ext)), mime)
+            for ext, mime, arguments in variants.VIDEO_FORMATS
+            if os.path.exists(variants.variant_path(thumb, ext))]
+
+
+app.jinja_env.globals['video_sources'] = video_sources
+
+
+# published images never change, so clients may cache them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# fallback images are cached briefly while a better variant is still being encoded
+PENDING_MAX_AGE = 10
+
+
+def send_immutable(directory, path):
+    response = send_from_directory(directory, path)
+    response.headers["Cache-Control"] = "public, max-age={:d}, immutable".format(IMMUTABLE_MAX_AGE)
+    return response
+
+
+def send_negotiated(directory, path, expected=None):
+    """
+    Sends the first pre-encoded variant (AVIF, then WebP) of an image the client accepts.
+    If a variant the client prefers is not encoded yet but the image was just written, the
+    response is only cached for a few seconds, so the client asks again once it is encoded.
+    :param expected: extensions of the variants encoded for this image, see variants.negotiate()
+    """
+    full_path = safe_join(directory, path)
+    if full_path is None:
+        abort(404)
+    variant, mimetype, pending = variants.negotiate(full_path, request.accept_mimetypes, expected)
+    if mimetype is not None:
+        directory, path = os.path.dirname(variant), os.path.basename(variant)
+    if pending:
+        response = send_from_directory(directory, path)
+        response.headers["Cache-Control"] = "public, max-age={:d}".format(PENDING_MAX_AGE)
+    else:
+        response = send_immutable(directory, path)
+    if mimetype is not None:
+        response.mimetype = mimetype
+    response.vary.add("Accept")
+    return response
+
+
+def send_listing(index, build):
+    """
+    Sends JSON that only depends on the gallery index. Clients revalidate
+    with the gallery entity tag, an unchanged gallery costs one 304 response.
+    :param index: Gallery or None
+    :param build: function that returns the JSON data
+    :return: Response
+    """
+    etag = index.etag if index is not None else "empty"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def gallery():
+    img_dir = app.config.get("IMAGE_DIR", None)
+    if img_dir is None:
+        return None
+    return get_gallery(img_dir).refresh()
+
+
+@app.route('/', defaults={'page': None})
 @app.route('/page/<int:page>')
 def index(page):
     per_page = 10
     images = []
-    img_dir = app.config.get("IMAGE_DIR", None)
+    total_count = 0
+    pagination = None
+    cursor = dict(prev=None, next=None)
 
-    # app.logger.info(app.config["IMAGE_DIR"])
-    if img_dir is not None and os.path.exists(img_dir):
-        types = ("*.gif", "*.jpg", "*.jpeg")
-        for t in types:
-            for img in glob.glob(os.path.join(app.config["IMAGE_DIR"], "thumbs", t)):
-                images.append(os.path.basename(img))
-    images = sorted(images, reverse=True)
-    total_count = len(images)
-    start = (page-1) * per_page
-    end = min(start + per_page, total_count -1)
-    images = images[start:end]
-    pagination = Pagination(page, per_page, total_count)
+    index = gallery()
+    if page is None:
+        # page by cursor
+        if index is not None:
+            images, cursor["prev"], cursor["next"] = index.cursor_page(after=request.args.get("after"),
+                                                                       before=request.args.get("before"),
+                                                                       limit=per_page)
+    else:
+        # page by number
+        if index is not None:
+            total_count = len(index)
+            images = index.page((page-1) * per_page, per_page)
+        pagination = Pagination(page, per_page, total_count)
     # app.logger.info(images)
-    return render_template('index.html', images=images, pagination=pagination)
+    return render_template('index.html', images=images, pagination=pagination, cursor=cursor)
 
 
 @app.route('/slideshow')
@@ -44,44 +146,200 @@ def slideshow():
 
 @app.route('/image/<path:path>')
 def send_image(path):
-    return send_from_directory(os.path.join(app.config.get("IMAGE_DIR", "."), "images"), path)
+    return send_immutable(os.path.join(app.config.get("IMAGE_DIR", "."), "images"), path)
 
 
 @app.route('/thumb/<path:path>')
 def send_thumb(path):
-    return send_from_directory(os.path.join(app.config.get("IMAGE_DIR", "."), "thumbs"), path)
+    return send_negotiated(os.path.join(app.config.get("IMAGE_DIR", "."), "thumbs"), path)
+
+
+@app.route('/thumb/<int:width>/<path:path>')
+def send_resized_thumb(width, path):
+    if width not in thumb_widths():
+        abort(404)
+    img_dir = app.config.get("IMAGE_DIR", ".")
+    if path.lower().endswith(".gif"):
+        # animations are not resized, but served as animated WebP if the client accepts it
+        return send_negotiated(os.path.join(img_dir, "thumbs"), path)
+    cache = get_thumbnail_cache(img_dir,
+                                widths=thumb_widths(),
+                                max_size=app.config.get("THUMB_CACHE_SIZE", THUMB_CACHE_SIZE))
+    variant = cache.get(path, width)
+    if variant is None:
+        abort(404)
+    # the cache writes the WebP variant before the JPEG, a missing one is never encoded later
+    return send_negotiated(os.path.dirname(variant), os.path.basename(variant), expected=())
 
 
 @app.route('/api/v1/latest_filename')
 def api_latest_filename():
-    img_dir = app.config.get("IMAGE_DIR", None)
-    latest = None
-    if img_dir is not None and os.path.exists(img_dir):
-        types = (".gif", ".jpg", ".jpeg")
-        # app.logger.info([img for img in os.listdir(os.path.join(app.config["IMAGE_DIR"], "thumbs"))])
-        images = sorted([img for img in os.listdir(os.path.join(app.config["IMAGE_DIR"], "thumbs")) if img.endswith(types)])
-        # app.logger.info(images)
-        if len(images):
-            latest = images[-1]
-    response = dict(latest=latest)
-    return jsonify(response)
+    index = gallery()
+
+    def build():
+        latest = None
+        if index is not None:
+            latest = index.latest()
+        return dict(latest=latest)
+
+    return send_listing(index, build)
 
 
 @app.route('/api/v1/images')
 def api_all_images():
-    images = []
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+    index = gallery()
+
+    def build():
+        images = []
+        prev_cursor = next_cursor = None
+        if index is not None:
+            images, prev_cursor, next_cursor = index.cursor_page(after=request.args.get("after"),
+                                                                 before=request.args.get("before"),
+                                                                 limit=limit)
+        return dict(images=images, prev=prev_cursor, next=next_cursor)
+
+    return send_listing(index, build)
+
+
+@app.route('/api/v1/catalog')
+def api_catalog():
+    """
+    Counts and byte sizes of the images per kind, optionally limited to a range
+    (?from=...&to=..., prefixes like 2019-06-01 are allowed)
+    """
+    index = gallery()
+    if index is None or index.catalog is None:
+        abort(404)
+
+    def build():
+        kinds = index.catalog.summary(request.args.get("from"), request.args.get("to"))
+        return dict(count=sum(kind["count"] for kind in kinds.values()), kinds=kinds)
+
+    return send_listing(index, build)
+
+
+@app.route('/api/v1/catalog/<path:name>')
+def api_catalog_image(name):
+    index = gallery()
+    if index is None or index.catalog is None:
+        abort(404)
+    record = index.catalog.get(name)
+    if record is None:
+        abort(404)
+    return jsonify(record)
+
+
+@app.route('/api/v1/archive.zip', methods=['GET', 'POST'])
+def api_archive():
+    """
+    Streams a ZIP archive of the original images. Select images by name
+    (?name=...&name=... or form field name) or by range (?from=...&to=...,
+    prefixes like 2019-06-01 are allowed). Range requests resume interrupted downloads.
+    """
+    index = gallery()
+    if index is None:
+        abort(404)
+    img_dir = app.config["IMAGE_DIR"]
+    names = request.values.getlist("name")
+    if not len(names):
+        names = index.range(request.args.get("from"), request.args.get("to"))
+
+    files = []
+    for name in names:
+        for directory in ("images", "thumbs"):
+            path = safe_join(img_dir, directory, name)
+            if path is not None and os.path.isfile(path):
+                files.append((name, path))
+                break
+    archive = ZipStream(files)
+    etag = archive.etag
+
+    start, stop = 0, archive.size
+    status = 200
+    if request.range is not None and (request.if_range.etag is None or request.if_range.etag == etag):
+        byte_range = request.range.range_for_length(archive.size)
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers["Content-Range"] = "bytes */{:d}".format(archive.size)
+            return response
+        start, stop = byte_range
+        status = 206
+
+    response = Response(archive.iter_bytes(start, stop), status=status, mimetype="application/zip")
+    response.headers["Content-Length"] = str(stop - start)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Disposition"] = "attachment; filename=photobooth.zip"
+    if status == 206:
+        response.headers["Content-Range"] = "bytes {:d}-{:d}/{:d}".format(start, stop - 1, archive.size)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/api/v1/events')
+def api_events():
+    index = gallery()
+    if index is None:
+        abort(404)
+    try:
+        generation = request.args.get("since", request.headers.get("Last-Event-ID"))
+        generation = int(generation) if generation is not None else None
+        timeout = min(float(request.args.get("timeout", 25)), 60)
+    except ValueError:
+        abort(400)
+
+    if request.accept_mimetypes.best == "text/event-stream":
+        response = Response(events.stream(index, generation), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+    return jsonify(events.poll(index, generation, timeout))
+
+
+@app.route('/api/v1/metrics')
+def api_metrics():
+    """
+    Stage timings and gauges of the photobooth as JSON or, with ?format=prometheus
+    or a text/plain Accept header, in the Prometheus text format
+    """
     img_dir = app.config.get("IMAGE_DIR", None)
+    snapshot = read_metrics(img_dir) if img_dir is not None else None
+    if snapshot is None:
+        abort(404)
+    if request.args.get("format") == "prometheus" or \
+            request.accept_mimetypes.best_match(["application/json", "text/plain"]) == "text/plain":
+        response = Response(prometheus(snapshot), mimetype="text/plain")
+        response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    else:
+        response = jsonify(snapshot)
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
-    # app.logger.info(app.config["IMAGE_DIR"])
-    if img_dir is not None and os.path.exists(img_dir):
-        types = ("*.gif", "*.jpg", "*.jpeg")
-        for t in types:
-            for img in glob.glob(os.path.join(app.config["IMAGE_DIR"], "thumbs", t)):
-                images.append(os.path.basename(img))
 
-    return jsonify(images)
+@app.route('/api/v1/traces')
+def api_traces():
+    """
+    Latency summary of the capture traces per event, ?hours=N limits it to the
+    last N hours, ?last=N adds the N newest traces
+    """
+    img_dir = app.config.get("IMAGE_DIR", None)
+    if img_dir is None:
+        abort(404)
+    try:
+        hours = request.args.get("hours")
+        since = time.time() - float(hours) * 3600 if hours is not None else None
+        last = int(request.args.get("last", 0))
+    except ValueError:
+        abort(400)
+    records = read_traces(img_dir, since)
+    data = dict(summary=summarize(records))
+    if last > 0:
+        data["traces"] = records[-last:]
+    response = jsonify(data)
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 
 @app.errorhandler(404)
 def page_not_found(e):
-    return index(1)
+    return index(None), 404
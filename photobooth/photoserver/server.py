@@ -0,0 +1,131 @@
+import logging
+import os
+import signal
+from gevent import socket
+from gevent.pywsgi import WSGIServer, WSGIHandler
+from gevent.socket import wait_write
+
+log = logging.getLogger("photoserver")
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper of the SendfileHandler. Iterating it reads the file
+    like any other response, the handler sends it with os.sendfile() instead.
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), b"")
+
+    def close(self):
+        self.filelike.close()
+
+
+class SendfileHandler(WSGIHandler):
+    """
+    gevent WSGI handler that sends file responses with os.sendfile(), so image
+    bodies go from the page cache to the socket without passing through Python.
+    """
+
+    def handle(self):
+        # headers and body are written separately, don't let Nagle's algorithm
+        # wait for the client's delayed ACK in between
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            pass
+        return super(SendfileHandler, self).handle()
+
+    def get_environ(self):
+        environ = super(SendfileHandler, self).get_environ()
+        environ["wsgi.file_wrapper"] = FileWrapper
+        return environ
+
+    def process_result(self):
+        if not isinstance(self.result, FileWrapper) or self.provided_content_length is None \
+                or getattr(self.server, "ssl_enabled", False):
+            return super(SendfileHandler, self).process_result()
+        try:
+            fd = self.result.filelike.fileno()
+            offset = self.result.filelike.tell()
+        except (AttributeError, OSError):
+            return super(SendfileHandler, self).process_result()
+        # send headers
+        self.write(b"")
+        self._sendfile(fd, offset, int(self.provided_content_length))
+
+    def _sendfile(self, fd, offset, count):
+        sock = self.socket.fileno()
+        while count > 0:
+            try:
+                sent = os.sendfile(sock, fd, offset, count)
+            except BlockingIOError:
+                wait_write(sock)
+                continue
+            if sent == 0:
+                raise IOError("file truncated while sending")
+            offset += sent
+            count -= sent
+            self.response_length += sent
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def serve(image_dir, host="127.0.0.1", port=5000, workers=1):
+    """
+    Runs the photoserver in the current process. With more than one worker the
+    listening socket is created first and shared by pre-forked worker processes,
+    each running its own gevent WSGIServer. The workers only share the image
+    directory with the photobooth, new images are found by the gallery index.
+    :param image_dir: photobooth image directory
+    :param host: listen address
+    :param port: listen port
+    :param workers: number of worker processes
+    """
+    from photobooth.photoserver import app
+    app.config["IMAGE_DIR"] = image_dir
+    listener = listen(host, port)
+    log.info("serving {} on http://{}:{:d} with {:d} worker(s)".format(image_dir, host, port, workers))
+
+    if workers <= 1:
+        WSGIServer(listener, app, handler_class=SendfileHandler).serve_forever()
+        return
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # worker: the parent handles termination
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                WSGIServer(listener, app, handler_class=SendfileHandler).serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    listener.close()
+    for child in children:
+        try:
+            os.waitpid(child, 0)
+        except ChildProcessError:
+            pass
@@ -0,0 +1,33 @@
+// Subscribes to new gallery images via server-sent events with a long-poll fallback.
+// onImage(name) is called for every new image, onReset() if the gallery has to be reloaded.
+function subscribeImages(onImage, onReset) {
+    if (window.EventSource) {
+        let source = new EventSource("/api/v1/events");
+        source.addEventListener("image", function (e) {
+            onImage(JSON.parse(e.data).name);
+        });
+        source.addEventListener("reset", function (e) {
+            onReset();
+        });
+        return;
+    }
+
+    let generation = null;
+    function poll() {
+        let params = generation == null ? {} : {since: generation};
+        $.getJSON("/api/v1/events", params, function (data) {
+            if (generation != null) {
+                if (data.reset) {
+                    onReset();
+                } else {
+                    data.images.forEach(onImage);
+                }
+            }
+            generation = data.generation;
+            poll();
+        }).fail(function () {
+            setTimeout(poll, 3000);
+        });
+    }
+    poll();
+}
@@ -0,0 +1,214 @@
+import os
+from collections import OrderedDict
+from threading import Lock, Event
+import cv2
+from PIL import Image
+from .variants import variant_path
+
+# widths of the thumbnail variants clients may request
+THUMB_WIDTHS = (160, 320, 640, 1280, 1920)
+# default size limit of the variant cache in bytes
+THUMB_CACHE_SIZE = 256 * 1024 * 1024
+JPEG_QUALITY = 80
+# WebP is cheap enough to encode while a client waits, AVIF is not
+WEBP_QUALITY = 80
+
+# DCT-scaled JPEG decoding, the decoder skips most of the work for large scale factors
+REDUCED_DECODE = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                  (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def reduced_flags(source_width, width):
+    """
+    Returns the imread/imdecode flags of the largest DCT scaling that keeps
+    an image at least as wide as requested
+    :param source_width: width of the encoded image
+    :param width: minimum width
+    :return: (flags, scale factor)
+    """
+    for factor, reduced in REDUCED_DECODE:
+        if source_width // factor >= width:
+            return reduced, factor
+    return cv2.IMREAD_COLOR, 1
+
+
+def read_reduced(path, width):
+    """
+    Reads an image with the largest DCT scaling that keeps it at least as wide as requested
+    :param path: image path
+    :param width: minimum width
+    :return: BGR image or None
+    """
+    flags = cv2.IMREAD_COLOR
+    try:
+        with Image.open(path) as img:
+            flags, factor = reduced_flags(img.size[0], width)
+    except (IOError, SyntaxError):
+        pass
+    return cv2.imread(path, flags)
+
+
+class ThumbnailCache:
+    """
+    Lazily generated thumbnail variants of fixed widths in <image_dir>/cache/<width>,
+    each stored as JPEG and WebP.
+
+    The cache is limited to max_size bytes and evicts the least recently used
+    variants. Concurrent requests for the same variant wait for a single
+    generation. Variants are written to a temporary file and renamed, so other
+    server processes sharing the directory never read partial files.
+    """
+
+    def __init__(self, image_dir, widths=THUMB_WIDTHS, max_size=THUMB_CACHE_SIZE):
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, "cache")
+        self.widths = tuple(widths)
+        self.max_size = max_size
+        self.size = 0
+        # variant path -> size in bytes, least recently used first
+        self._entries = None
+        # variant path -> Event set when the generation finished
+        self._pending = {}
+        self._lock = Lock()
+
+    def _load(self):
+        """
+        Indexes variants of previous runs, oldest first
+        """
+        entries = []
+        for width in self.widths:
+            path = os.path.join(self.path, str(width))
+            if not os.path.isdir(path):
+                continue
+            for entry in os.scandir(path):
+                if entry.name.startswith(".") or entry.name.endswith(".webp"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, self._disk_size(entry.path)))
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self.size = sum(self._entries.values())
+
+    @staticmethod
+    def _files(path):
+        return path, variant_path(path, "webp")
+
+    def _disk_size(self, path):
+        return sum(os.path.getsize(f) for f in self._files(path) if os.path.exists(f))
+
+    def cache_path(self, name, width):
+        return os.path.join(self.path, str(width), os.path.basename(name))
+
+    def source_path(self, name, width):
+        """
+        Returns the smallest published image that is at least as wide as the variant
+        """
+        name = os.path.basename(name)
+        thumb = os.path.join(self.image_dir, "thumbs", name)
+        image = os.path.join(self.image_dir, "images", name)
+        if os.path.exists(thumb):
+            try:
+                with Image.open(thumb) as img:
+                    if img.size[0] >= width or not os.path.exists(image):
+                        return thumb
+            except IOError:
+                pass
+        if os.path.exists(image):
+            return image
+        return None
+
+    def get(self, name, width):
+        """
+        Returns the path of a thumbnail variant and generates it if necessary
+        :param name: image name
+        :param width: one of the allowed widths
+        :return: path to variant or None if there is no such image
+        """
+        if width not in self.widths:
+            raise ValueError("Width {} not allowed".format(width))
+        path = self.cache_path(name, width)
+        while True:
+            with self._lock:
+                if self._entries is None:
+                    self._load()
+                if path in self._entries:
+                    if os.path.exists(path):
+                        self._entries.move_to_end(path)
+                        return path
+                    # evicted by another process
+                    self.size -= self._entries.pop(path)
+                pending = self._pending.get(path)
+                if pending is None:
+                    pending = self._pending[path] = Event()
+                    break
+            # another request is generating this variant
+            pending.wait()
+
+        try:
+            if not os.path.exists(path) and not self._generate(name, width, path):
+                return None
+            with self._lock:
+                size = self._disk_size(path)
+                self._entries[path] = size
+                self.size += size
+                self._evict()
+            return path
+        finally:
+            with self._lock:
+                del self._pending[path]
+            pending.set()
+
+    def _generate(self, name, width, path):
+        source = self.source_path(name, width)
+        if source is None:
+            return False
+        img = read_reduced(source, width)
+        if img is None:
+            return False
+        if img.shape[1] > width:
+            height = int(round(img.shape[0] * width / float(img.shape[1])))
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the WebP variant first, a JPEG on disk marks a complete entry
+        jpeg_path, webp_path = self._files(path)
+        ok, webp = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY])
+        if ok:
+            self._write(webp_path, webp)
+        ok, jpeg = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            return False
+        self._write(jpeg_path, jpeg)
+        return True
+
+    @staticmethod
+    def _write(path, data):
+        tmp_path = os.path.join(os.path.dirname(path), ".{}.tmp".format(os.path.basename(path)))
+        with open(tmp_path, "wb") as f:
+            f.write(data.tobytes())
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self.size -= size
+            for f in self._files(path):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def get_thumbnail_cache(image_dir, widths=THUMB_WIDTHS, max_size=THUMB_CACHE_SIZE):
+    """
+    Returns the shared thumbnail cache of an image directory
+    """
+    key = os.path.abspath(image_dir)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ThumbnailCache(key, widths=widths, max_size=max_size)
+    return cache
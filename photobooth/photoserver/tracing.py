@@ -0,0 +1,203 @@
+"""
+Traces of captures from the button press until the photo is listed by the photoserver.
+
+The photobooth writes one JSON line per finished trace to .traces.jsonl in the
+image directory, the photoserver and the command line summarize them per event:
+
+    python -m photobooth.photoserver.tracing ~/photobooth
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+from threading import Lock
+from .metrics import RollingHistogram
+
+TRACES_NAME = ".traces.jsonl"
+# the file is rotated to <name>.1 at this size, about 5000 traces
+TRACES_MAX_BYTES = 4 * 1024 * 1024
+
+
+class Trace:
+    """
+    Spans of one capture. Times are time.perf_counter() values, spans may be
+    recorded from any thread. The trace is written once by finish().
+    """
+
+    def __init__(self, tracer, kind, t=None):
+        """
+        :param tracer: Tracer that writes the finished trace
+        :param kind: event name, e.g. "photo"
+        :param t: perf_counter() time the event started, e.g. of the button press, now if None
+        """
+        self.tracer = tracer
+        self.kind = kind
+        self.id = uuid.uuid4().hex[:16]
+        self.t0 = time.perf_counter() if t is None else t
+        # wall clock time of t0
+        self.started = time.time() - (time.perf_counter() - self.t0)
+        self.last = self.t0
+        self.spans = []
+        self.finished = False
+        self._lock = Lock()
+
+    def add(self, name, start, end=None):
+        """
+        Records a span
+        :param start: perf_counter() start time
+        :param end: perf_counter() end time, now if None
+        """
+        end = time.perf_counter() if end is None else end
+        with self._lock:
+            self.spans.append((name, start, end))
+            self.last = max(self.last, end)
+
+    def since_last(self, name):
+        """
+        Records the time since the end of the latest span, e.g. waiting in a queue
+        """
+        self.add(name, self.last)
+
+    def span(self, name):
+        """
+        Context manager that records the time of its block
+        """
+        return _Span(self, name)
+
+    def finish(self, **attributes):
+        """
+        Writes the trace, later calls are ignored
+        :param attributes: extra fields, e.g. the file name
+        """
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            end = max(self.last, time.perf_counter())
+            record = dict(id=self.id,
+                          kind=self.kind,
+                          time=self.started,
+                          total_ms=(end - self.t0) * 1000,
+                          spans=[dict(name=name,
+                                      start_ms=(start - self.t0) * 1000,
+                                      duration_ms=(stop - start) * 1000)
+                                 for name, start, stop in self.spans])
+        record.update(attributes)
+        self.tracer.write(record)
+
+    def __str__(self):
+        return "{} {}".format(self.kind, self.id)
+
+
+class _Span:
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.trace.add(self.name, self.start)
+
+
+class Tracer:
+    """
+    Appends finished traces to a JSONL file that is rotated once it reaches max_bytes
+    """
+
+    def __init__(self, image_dir, max_bytes=TRACES_MAX_BYTES):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.path = os.path.join(image_dir, TRACES_NAME)
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+
+    def start(self, kind, t=None):
+        """
+        :return: new Trace
+        """
+        return Trace(self, kind, t)
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a") as f:
+                    f.write(line)
+            except (IOError, OSError) as e:
+                self.log.warning("writing trace failed: {}".format(e))
+
+
+def read_traces(image_dir, since=None):
+    """
+    Reads the traces of the rotated and the current file
+    :param since: only traces that started after this wall clock time
+    :return: list of trace dicts, oldest first
+    """
+    path = os.path.join(image_dir, TRACES_NAME)
+    records = []
+    for name in (path + ".1", path):
+        try:
+            with open(name) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut off by a crash
+                        continue
+                    if since is None or record["time"] >= since:
+                        records.append(record)
+        except IOError:
+            pass
+    return records
+
+
+def summarize(records):
+    """
+    End-to-end and per span latency percentiles per event
+    :param records: trace dicts
+    :return: dict kind -> dict(count, total, spans=dict name -> summary), durations in ms
+    """
+    kinds = {}
+    for record in records:
+        kind = kinds.setdefault(record["kind"], dict(total=RollingHistogram(None), spans={}))
+        kind["total"].add(record["total_ms"] / 1000.0)
+        for span in record["spans"]:
+            histogram = kind["spans"].setdefault(span["name"], RollingHistogram(None))
+            histogram.add(span["duration_ms"] / 1000.0)
+    return {name: dict(count=kind["total"].count,
+                       total=kind["total"].summary(),
+                       spans={span: histogram.summary() for span, histogram in kind["spans"].items()})
+            for name, kind in kinds.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency summary of the capture traces of a photobooth')
+    parser.add_argument('image_dir', type=str, help='image directory of the photobooth')
+    parser.add_argument('--hours', type=float, help='only traces of the last N hours', default=None)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON', default=False)
+    args = parser.parse_args()
+
+    since = time.time() - args.hours * 3600 if args.hours is not None else None
+    summary = summarize(read_traces(os.path.expanduser(args.image_dir), since))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    line = "{:>16s} {:>6d} {:10.1f} {:10.1f} {:10.1f}"
+    for kind, s in sorted(summary.items()):
+        print("{:>16s} {:>6s} {:>10s} {:>10s} {:>10s}".format(kind, "count", "p50 ms", "p95 ms", "max ms"))
+        print(line.format("total", s["count"], s["total"]["p50_ms"], s["total"]["p95_ms"], s["total"]["max_ms"]))
+        # in pipeline order
+        for span, h in s["spans"].items():
+            print(line.format(span, h["count"], h["p50_ms"], h["p95_ms"], h["max_ms"]))
+        print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import logging
+import os
+import shutil
+import subprocess
+import time
+from functools import lru_cache
+from queue import Queue
+from threading import Thread
+from PIL import Image, features
+
+# preferred formats first: (file extension, mime type, Pillow save options)
+FORMATS = (("avif", "image/avif", dict(quality=60, speed=8)),
+           ("webp", "image/webp", dict(quality=80, method=4)))
+# variants of animated GIFs, served instead of the GIF through the same negotiation
+ANIMATION_FORMATS = (("webp", "image/webp", dict(quality=75, method=4, save_all=True, loop=0)),)
+# video variants of animated GIFs for <video> elements, encoded by ffmpeg: (file extension, mime type, arguments)
+VIDEO_FORMATS = (("mp4", "video/mp4", ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
+                                       "-pix_fmt", "yuv420p", "-movflags", "+faststart", "-f", "mp4"]),
+                 ("webm", "video/webm", ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8",
+                                         "-crf", "35", "-b:v", "0", "-f", "webm"]))
+# video formats encoded by default, WebM only on request
+DEFAULT_VIDEO_FORMATS = ("mp4",)
+# seconds ffmpeg may take for one video
+FFMPEG_TIMEOUT = 120
+# seconds after a thumbnail is written in which the encoder may still be writing its variants,
+# older thumbnails without a variant never get one, e.g. of galleries from before the variants
+VARIANT_PENDING_TIME = 300
+
+
+@lru_cache(maxsize=None)
+def available_formats():
+    """
+    Returns the extensions of the formats the installed Pillow can encode, checked once
+    """
+    formats = []
+    for ext, mime, options in FORMATS:
+        try:
+            if features.check(ext):
+                formats.append(ext)
+        except ValueError:
+            # unknown feature in older Pillow versions
+            pass
+    return tuple(formats)
+
+
+@lru_cache(maxsize=None)
+def available_animation_formats():
+    """
+    Returns the extensions of the GIF variants that can be encoded here:
+    animated WebP with Pillow, videos if an ffmpeg binary is found, checked once
+    """
+    formats = []
+    for ext, mime, options in ANIMATION_FORMATS:
+        try:
+            if features.check(ext):
+                formats.append(ext)
+        except ValueError:
+            pass
+    if shutil.which("ffmpeg") is not None:
+        formats.extend(DEFAULT_VIDEO_FORMATS)
+    return tuple(formats)
+
+
+def variant_path(path, ext):
+    """
+    Variants are stored next to the JPEG, e.g. thumbs/<name>.jpg.webp
+    """
+    return "{}.{}".format(path, ext)
+
+
+def expected_formats(path):
+    """
+    Returns the extensions of the image variants the encoder writes for an image
+    :param path: JPEG or GIF path
+    """
+    if path.lower().endswith(".gif"):
+        image_formats = [ext for ext, mime, options in ANIMATION_FORMATS]
+        return [ext for ext in available_animation_formats() if ext in image_formats]
+    return available_formats()
+
+
+def is_recent(path, now=None):
+    """
+    Whether an image was written so recently that the encoder may still be working on its variants
+    """
+    now = time.time() if now is None else now
+    try:
+        return os.path.getmtime(path) > now - VARIANT_PENDING_TIME
+    except OSError:
+        return False
+
+
+def negotiate(path, accept_mimetypes, expected=None):
+    """
+    Selects the first variant in the order of FORMATS (AVIF, then WebP) the client accepts
+    :param path: path to JPEG image
+    :param accept_mimetypes: werkzeug MIMEAccept of the request
+    :param expected: extensions of the variants encoded for this image, expected_formats() if None
+    :return: path and mime type of the variant or the JPEG path and None, and whether
+             a preferred variant the client accepts may still be written, see is_recent()
+    """
+    if expected is None:
+        expected = expected_formats(path)
+    accepted = set(value for value, quality in accept_mimetypes if quality > 0)
+    pending = False
+    for ext, mime, options in FORMATS:
+        if mime in accepted:
+            candidate = variant_path(path, ext)
+            if os.path.exists(candidate):
+                return candidate, mime, pending
+            if ext in expected and not pending:
+                pending = is_recent(path)
+    return path, None, pending
+
+
+def _tmp_path(target):
+    return os.path.join(os.path.dirname(target), ".{}.tmp".format(os.path.basename(target)))
+
+
+def encode_animation_variants(path, formats=None):
+    """
+    Encodes the animated WebP and video variants of a GIF
+    :param path: path to GIF
+    :param formats: list of extensions or None for all available formats
+    :return: list of written variant paths
+    """
+    if formats is None:
+        formats = available_animation_formats()
+    written = []
+    for ext, mime, options in ANIMATION_FORMATS:
+        if ext not in formats:
+            continue
+        target = variant_path(path, ext)
+        tmp_path = _tmp_path(target)
+        with Image.open(path) as img:
+            # keeps the frame durations of the GIF
+            img.save(tmp_path, format=ext.upper(), **options)
+        os.replace(tmp_path, target)
+        written.append(target)
+    ffmpeg = shutil.which("ffmpeg")
+    for ext, mime, arguments in VIDEO_FORMATS:
+        if ext not in formats or ffmpeg is None:
+            continue
+        target = variant_path(path, ext)
+        tmp_path = _tmp_path(target)
+        # H.264 and VP9 need even dimensions
+        cmd = [ffmpeg, "-y", "-v", "error", "-i", path, "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2"] + \
+            arguments + [tmp_path]
+        try:
+            subprocess.run(cmd, check=True, timeout=FFMPEG_TIMEOUT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            stderr = getattr(e, "stderr", None) or b""
+            raise IOError("ffmpeg {} failed: {}".format(ext, stderr.decode("utf-8", "replace").strip() or e))
+        os.replace(tmp_path, target)
+        written.append(target)
+    return written
+
+
+def encode_variants(path, formats=None):
+    """
+    Encodes the WebP/AVIF variants of a JPEG image or the animated variants of a GIF
+    :param path: path to JPEG image or GIF
+    :param formats: list of extensions or None for all available formats
+    :return: list of written variant paths
+    """
+    if path.lower().endswith(".gif"):
+        return encode_animation_variants(path, formats)
+    if formats is None:
+        formats = available_formats()
+    written = []
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+        for ext, mime, options in FORMATS:
+            if ext not in formats:
+                continue
+            target = variant_path(path, ext)
+            tmp_path = _tmp_path(target)
+            img.save(tmp_path, format=ext.upper(), **options)
+            os.replace(tmp_path, target)
+            written.append(target)
+    return written
+
+
+class VariantEncoder:
+    """
+    Background worker that encodes the WebP/AVIF variants of published JPEG images
+    and the animated WebP and video variants of published GIFs
+    """
+
+    def __init__(self, formats=None, animation_formats=None, callback=None):
+        """
+        :param formats: variant formats, all available formats by default
+        :param animation_formats: GIF variant formats, all available formats by default
+        :param callback: called with the image path and the list of written formats
+        """
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.formats = available_formats() if formats is None else formats
+        self.animation_formats = available_animation_formats() if animation_formats is None else animation_formats
+        self.callback = callback
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, path):
+        if path.lower().endswith((".jpg", ".jpeg")) and len(self.formats):
+            self.queue.put(path)
+        elif path.lower().endswith(".gif") and len(self.animation_formats):
+            self.queue.put(path)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                break
+            try:
+                written = []
+                formats = self.animation_formats if path.lower().endswith(".gif") else self.formats
+                for variant in encode_variants(path, formats):
+                    self.log.debug("wrote {}".format(variant))
+                    written.append(os.path.splitext(variant)[1][1:])
+                if self.callback is not None and len(written):
+                    self.callback(path, written)
+            except Exception as e:
+                self.log.error("encoding variants of {} failed: {}".format(path, e))
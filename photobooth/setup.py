@@ -10,7 +10,6 @@ setup(name='photobooth',
                         'flask',
                         'gevent',
                         'pygame',
-                        'imageio',
                         'pigpio'
                         ]
       )
@@ -0,0 +1,33 @@
+import socket
+import time
+from photobooth.photobooth import UDPInput, Action
+from photobooth.photobooth.events import InputBus
+
+
+def send_and_collect(udp, datagrams):
+    bus = InputBus()
+    udp.start(bus)
+    port = udp.socket.getsockname()[1]
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for data in datagrams:
+        sender.sendto(data, ("127.0.0.1", port))
+    sender.close()
+    time.sleep(0.2)
+    udp.close()
+    actions = []
+    event = bus.get()
+    while event is not None:
+        actions.append(event.action)
+        event = bus.get()
+    return actions
+
+
+def test_udp_input_listens_on_localhost_without_print():
+    udp = UDPInput(port=0)
+    assert udp.socket.getsockname()[0] == "127.0.0.1"
+    assert send_and_collect(udp, [b"photo", b"print_last_photo", b"exit"]) == [Action.photo]
+
+
+def test_udp_input_requires_the_token():
+    udp = UDPInput(port=0, token="secret")
+    assert send_and_collect(udp, [b"photo", b"wrong gif", b"secret strip"]) == [Action.strip]
@@ -0,0 +1,29 @@
+import os
+from photobooth.photoserver import metrics
+from photobooth.photoserver.metrics import Metrics, read_metrics, metrics_path
+
+
+def test_snapshots_are_written_to_the_tmpfs(tmp_path, monkeypatch):
+    tmpfs = tmp_path / "shm"
+    tmpfs.mkdir()
+    monkeypatch.setattr(metrics, "METRICS_TMPFS", str(tmpfs))
+    image_dir = str(tmp_path / "images")
+    m = Metrics()
+    for fps in (10, 20):
+        m.set("fps", fps)
+        m.dump(image_dir)
+        assert read_metrics(image_dir)["gauges"]["fps"] == fps
+    assert os.path.dirname(metrics_path(image_dir)) == str(tmpfs)
+    assert metrics_path(image_dir) != metrics_path(str(tmp_path / "other"))
+    assert os.listdir(str(tmpfs)) == [os.path.basename(metrics_path(image_dir))]
+
+
+def test_snapshots_without_tmpfs_are_written_less_often(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TMPFS", str(tmp_path / "missing"))
+    m = Metrics()
+    m.set("fps", 10)
+    m.dump(str(tmp_path))
+    m.set("fps", 20)
+    m.dump(str(tmp_path))
+    assert metrics_path(str(tmp_path)) == str(tmp_path / metrics.METRICS_NAME)
+    assert read_metrics(str(tmp_path))["gauges"]["fps"] == 10
@@ -0,0 +1,47 @@
+import datetime
+import os
+from photobooth.photobooth.persistence import PersistenceQueue, ImageNames, write_atomic
+
+
+def test_names_in_the_same_second_are_unique(tmp_path):
+    names = ImageNames(str(tmp_path))
+    now = datetime.datetime(2024, 5, 4, 20, 15, 30)
+    assert [names.reserve(now=now) for i in range(3)] == ["2024-05-04_20-15-30.jpg",
+                                                         "2024-05-04_20-15-30-2.jpg",
+                                                         "2024-05-04_20-15-30-3.jpg"]
+    assert names.reserve("gif", now=now) == "2024-05-04_20-15-30.gif"
+
+
+def test_names_skip_existing_files(tmp_path):
+    (tmp_path / "2024-05-04_20-15-30.jpg").write_bytes(b"earlier run")
+    names = ImageNames(str(tmp_path))
+    assert names.reserve(now=datetime.datetime(2024, 5, 4, 20, 15, 30)) == "2024-05-04_20-15-30-2.jpg"
+
+
+def test_saves_with_the_same_timestamp_all_survive(tmp_path):
+    names = ImageNames(str(tmp_path))
+    now = datetime.datetime(2024, 5, 4, 20, 15, 30)
+    queue = PersistenceQueue(workers=4, maxsize=2)
+    expected = {}
+    for i in range(12):
+        name = names.reserve(now=now)
+        data = "capture {:d}".format(i).encode() * 10000
+        expected[name] = data
+        queue.submit(write_atomic, str(tmp_path / name), data)
+    queue.close()
+    assert sorted(os.listdir(str(tmp_path))) == sorted(expected)
+    for name, data in expected.items():
+        assert (tmp_path / name).read_bytes() == data
+
+
+def test_concurrent_writes_of_one_path_leave_a_complete_file(tmp_path):
+    path = str(tmp_path / "image.jpg")
+    queue = PersistenceQueue(workers=4, maxsize=2)
+    versions = [bytes([i]) * 100000 for i in range(16)]
+    for data in versions:
+        queue.submit(write_atomic, path, data)
+    queue.close()
+    # no temporary files left behind, the file is one of the versions in full
+    assert os.listdir(str(tmp_path)) == ["image.jpg"]
+    with open(path, "rb") as f:
+        assert f.read() in versions
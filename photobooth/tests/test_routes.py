@@ -0,0 +1,53 @@
+import os
+import time
+import pytest
+from photobooth.photoserver import app, routes, variants
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    (tmp_path / "thumbs").mkdir()
+    (tmp_path / "thumbs" / "x.jpg").write_bytes(b"jpeg")
+    monkeypatch.setitem(app.config, "IMAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(variants, "available_formats", lambda: ["webp"])
+    return app.test_client()
+
+
+def test_fallback_of_a_new_image_is_not_immutable_until_variant_is_written(client, tmp_path):
+    response = client.get("/thumb/x.jpg", headers={"Accept": "image/webp,*/*"})
+    assert response.mimetype == "image/jpeg"
+    assert response.headers["Cache-Control"] == "public, max-age={:d}".format(routes.PENDING_MAX_AGE)
+    assert "Accept" in response.headers["Vary"]
+    response.close()
+
+    (tmp_path / "thumbs" / "x.jpg.webp").write_bytes(b"webp")
+    response = client.get("/thumb/x.jpg", headers={"Accept": "image/webp,*/*"})
+    assert response.mimetype == "image/webp"
+    assert response.data == b"webp"
+    assert "immutable" in response.headers["Cache-Control"]
+    response.close()
+
+
+def test_fallback_of_an_old_image_without_variant_is_immutable(client, tmp_path):
+    # e.g. a gallery from before the variants or an image whose encoding failed
+    old = time.time() - variants.VARIANT_PENDING_TIME - 1
+    os.utime(str(tmp_path / "thumbs" / "x.jpg"), (old, old))
+    response = client.get("/thumb/x.jpg", headers={"Accept": "image/avif,image/webp,*/*"})
+    assert response.mimetype == "image/jpeg"
+    assert "immutable" in response.headers["Cache-Control"]
+    response.close()
+
+
+def test_fallback_is_immutable_if_no_variant_is_accepted(client):
+    response = client.get("/thumb/x.jpg", headers={"Accept": "image/jpeg"})
+    assert response.mimetype == "image/jpeg"
+    assert "immutable" in response.headers["Cache-Control"]
+    response.close()
+
+
+def test_fallback_is_immutable_if_no_variant_is_encoded(client, monkeypatch):
+    monkeypatch.setattr(variants, "available_formats", lambda: [])
+    response = client.get("/thumb/x.jpg", headers={"Accept": "image/avif,image/webp,*/*"})
+    assert response.mimetype == "image/jpeg"
+    assert "immutable" in response.headers["Cache-Control"]
+    response.close()
@@ -0,0 +1,89 @@
+import os
+import time
+from threading import Event
+import numpy as np
+from PIL import Image
+from photobooth.photobooth import tools
+from photobooth.photobooth.tools import GIFCreator, StreamingGIFCreator
+
+
+def stall_encoder(monkeypatch):
+    release = Event()
+    add = tools.GIFStream.add
+
+    def stalled_add(stream, frame):
+        release.wait()
+        add(stream, frame)
+
+    monkeypatch.setattr(tools.GIFStream, "add", stalled_add)
+    return release
+
+
+def test_recording_does_not_wait_for_a_stalled_encoder(tmp_path, monkeypatch):
+    release = stall_encoder(monkeypatch)
+    path = str(tmp_path / "x.gif")
+    written = []
+    gif = StreamingGIFCreator(path, size=10, pause=0, callback=written.append)
+    t = time.perf_counter()
+    i = 0
+    while not gif.is_full() and i < 1000:
+        frame = np.full((48, 64, 3), i % 256, dtype=np.uint8)
+        gif.update(frame)
+        if i == 20:
+            release.set()
+        i += 1
+        time.sleep(0.001)
+    gif.finish()
+    assert time.perf_counter() - t < 5
+    assert gif.dropped > 0
+    gif.join()
+    assert written == [path]
+    with Image.open(path) as img:
+        assert img.n_frames == len(gif) == 10
+
+
+def test_finish_with_a_full_queue_does_not_block(tmp_path, monkeypatch):
+    release = stall_encoder(monkeypatch)
+    path = str(tmp_path / "x.gif")
+    gif = StreamingGIFCreator(path, size=10, pause=0)
+    for i in range(10):
+        gif.update(np.full((48, 64, 3), i, dtype=np.uint8))
+        time.sleep(0.001)
+    assert gif.queue.full()
+    t = time.perf_counter()
+    gif.abort()
+    assert time.perf_counter() - t < 0.1
+    release.set()
+    gif.join()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_streaming_palette_covers_more_than_the_first_frame(tmp_path):
+    path = str(tmp_path / "x.gif")
+    gif = StreamingGIFCreator(path, size=3, pause=0)
+    colors = [(0, 0, 0), (0, 0, 255), (0, 255, 0)]
+    for color in colors:
+        gif.update(np.full((48, 64, 3), color, dtype=np.uint8))
+        time.sleep(0.002)
+    gif.join()
+    with Image.open(path) as img:
+        for i, (b, g, r) in enumerate(colors):
+            img.seek(i)
+            assert img.convert("RGB").getpixel((10, 10)) == (r, g, b)
+
+
+def test_gif_creator_encodes_gif_and_thumbnail(tmp_path):
+    gif = GIFCreator(size=3, pause=0)
+    for i in range(3):
+        gif.update(np.full((48, 64, 3), i * 100, dtype=np.uint8))
+        time.sleep(0.002)
+    assert gif.is_full()
+    written = []
+    path, thumb_path = str(tmp_path / "x.gif"), str(tmp_path / "thumb.gif")
+    gif.save(path, thumb_path, thumb_width=32, callback=written.append)
+    assert written == [thumb_path]
+    with Image.open(path) as img:
+        assert img.n_frames == 3 and img.size == (64, 48)
+    with Image.open(thumb_path) as img:
+        assert img.n_frames == 3 and img.size == (32, 24)
+    assert sorted(os.listdir(str(tmp_path))) == ["thumb.gif", "x.gif"]